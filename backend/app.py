@@ -1,82 +1,306 @@
 """
 Servidor Flask para la aplicación de Presupuestos NAUKA
 """
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context
+from flask.json.provider import JSONProvider
+from flask.logging import default_handler
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_compress import Compress
+from whitenoise import WhiteNoise
+from prometheus_flask_exporter import PrometheusMetrics
 from pathlib import Path
+from functools import lru_cache, wraps
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import logging
+import queue
+import multiprocessing
+import hashlib
+import re
 import sys
+import tempfile
+import uuid
+import orjson
 
 # Agregar el directorio actual al path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from models import (
-    init_database,
+    init_database, liberar_conexion,
     obtener_proyectos, obtener_proyecto, crear_proyecto, eliminar_proyecto,
-    obtener_partidas, obtener_partida, crear_partida, actualizar_partida, eliminar_partida,
+    obtener_version_partidas,
+    iter_partidas, obtener_partida, crear_partida, crear_partidas_bulk,
+    actualizar_partida, actualizar_partidas_bulk, eliminar_partida, eliminar_partidas,
     obtener_categorias_proyecto, obtener_conceptos_proyecto,
     obtener_resumen_proyecto, obtener_tipos_cambio, actualizar_tipo_cambio,
     obtener_resumen_agrupado, obtener_torres_proyecto, obtener_pisos_proyecto,
-    obtener_proveedores_proyecto, obtener_deptos_proyecto,
-    obtener_resumen_jerarquico_nivel1, obtener_resumen_jerarquico_nivel2,
-    obtener_resumen_jerarquico_nivel3,
+    obtener_proveedores_proyecto, obtener_deptos_proyecto, obtener_filtros_proyecto,
+    obtener_resumen_jerarquico,
     obtener_glosario_proyecto, agregar_categoria_glosario, eliminar_categoria_glosario,
     agregar_concepto_glosario, eliminar_concepto_glosario, importar_glosario_desde_partidas,
-    importar_glosario_desde_excel,
+    importar_glosario_desde_excel, crear_trabajo, finalizar_trabajo, obtener_trabajo,
+    marcar_trabajos_abandonados,
     obtener_proveedores_por_categoria_global, obtener_estadisticas_proveedor,
     # Cotizaciones
-    crear_cotizacion, obtener_cotizaciones, obtener_cotizacion, actualizar_cotizacion,
-    eliminar_cotizacion, crear_items_cotizacion, obtener_items_cotizacion,
+    obtener_cotizaciones, obtener_cotizacion, actualizar_cotizacion,
+    eliminar_cotizacion, obtener_items_cotizacion,
     actualizar_item_cotizacion, eliminar_item_cotizacion,
-    obtener_proveedores_cotizaciones, comparar_unitarios
+    obtener_proveedores_cotizaciones, comparar_unitarios, buscar_cotizacion_por_hash
 )
-from pdf_processor import extraer_items_excel_bytes
+from trabajos import ejecutar_trabajo, procesar_cotizacion_excel, resultado_cotizacion_duplicada
+from esquemas import (
+    ProyectoEntrada, PartidaEntrada, ListaPartidasEntrada, ListaPartidasActualizacionEntrada,
+    TipoCambioEntrada, NombreEntrada, IdsEntrada
+)
+from pydantic import ValidationError
+from werkzeug.exceptions import HTTPException, InternalServerError
+import models
 
 # Ruta de los archivos Excel
 EXCEL_PATH = Path("C:/Users/Alfonso Ison/iCloudDrive/Desktop/PPTO NAUKA CLAUDE")
 
-app = Flask(__name__, static_folder='../frontend', static_url_path='')
+# Archivo Excel de cada proyecto: (patrón sobre el nombre del proyecto, ruta)
+# Los números van delimitados para que "Lote 3" no coincida con "Lote 33"
+ARCHIVOS_EXCEL_PROYECTO = [
+    (re.compile(r'beachfront', re.I), EXCEL_PATH / "IZ - NAUKA PPTO Beachfront 170125.xlsx"),
+    (re.compile(r'lote ?3(?!\d)', re.I), EXCEL_PATH / "IZ - NAUKA PPTO Lote 3 170126.xlsx"),
+    (re.compile(r'lote ?44(?!\d)', re.I), EXCEL_PATH / "IZ - NAUKA PPTO Lote 44 170126.xlsx"),
+    (re.compile(r'golf', re.I), EXCEL_PATH / "NAUKA - PPTO Casas Golf 281025.xlsx"),
+]
+
+@lru_cache(maxsize=None)
+def archivo_excel_proyecto(nombre_proyecto):
+    """Obtener la ruta del Excel que corresponde a un proyecto (None si no hay)"""
+    return next((ruta for patron, ruta in ARCHIVOS_EXCEL_PROYECTO if patron.search(nombre_proyecto)), None)
+
+class OrjsonProvider(JSONProvider):
+    """Serializador JSON basado en orjson (más rápido que el json estándar)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson ya devuelve bytes: evitar la conversión str -> bytes de jsonify
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), mimetype='application/json'
+        )
+
+# Ruta del frontend estático
+FRONTEND_PATH = Path(__file__).parent.parent / "frontend"
+
+app = Flask(__name__, static_folder=None)
+app.json = OrjsonProvider(app)
 CORS(app)
 
-# Inicializar base de datos al arrancar
-init_database()
+# Registro: la petición sólo encola el mensaje y un hilo aparte lo escribe en stderr
+cola_logs = queue.SimpleQueue()
+escritor_logs = QueueListener(cola_logs, default_handler)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(QueueHandler(cola_logs))
+app.logger.setLevel(logging.INFO)
+escritor_logs.start()
+atexit.register(escritor_logs.stop)
+
+# Archivos con hash de contenido en el nombre (app.3f9c2a1b.js): nunca cambian
+ARCHIVO_CON_HASH = re.compile(r'\.[0-9a-f]{8,}\.(js|css)$')
+
+def es_archivo_inmutable(ruta, url):
+    """Los assets con hash se cachean un año como 'immutable'"""
+    return bool(ARCHIVO_CON_HASH.search(url))
+
+def cabeceras_estaticos(headers, ruta, url):
+    """index.html se revalida siempre para que los despliegues se vean al recargar"""
+    if url == '/' or url.endswith('.html'):
+        headers['Cache-Control'] = 'no-cache'
+
+# WhiteNoise sirve el frontend antes de llegar a Flask (con Last-Modified/ETag y 304)
+app.wsgi_app = WhiteNoise(
+    app.wsgi_app,
+    root=str(FRONTEND_PATH),
+    index_file=True,
+    immutable_file_test=es_archivo_inmutable,
+    add_headers_function=cabeceras_estaticos,
+)
+
+# Cache para los GET de solo lectura (se limpia al modificar datos). Va en archivos
+# y no en memoria para que la compartan todos los workers de gunicorn: el
+# cache.clear() del worker que atendió una escritura invalida también a los demás.
+# Una carpeta por base de datos para no mezclar instancias en el mismo equipo
+app.config.from_mapping(
+    CACHE_TYPE='FileSystemCache',
+    CACHE_DIR=str(Path(tempfile.gettempdir()) / (
+        'presupuestos_nauka_cache_'
+        + hashlib.blake2b(str(Path(models.DATABASE_PATH).resolve()).encode(), digest_size=8).hexdigest()
+    )),
+    CACHE_DEFAULT_TIMEOUT=60,
+)
+# Permitir configurar desde el entorno, ej. FLASK_CACHE_TYPE=RedisCache con varios equipos
+app.config.from_prefixed_env()
+cache = Cache(app)
+
+# Comprimir las respuestas JSON de la API (Brotli si el navegador lo acepta, si no gzip).
+# Por debajo de ~1 KB la cabecera y el tiempo de CPU no compensan el ahorro.
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json'],
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_ALGORITHM_STREAMING=['br', 'deflate'],
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_LEVEL=4,
+    COMPRESS_BR_LEVEL=4,
+)
+Compress(app)
+
+# Métricas Prometheus en /metrics: latencia (histograma) por método, ruta y status.
+# Se agrupa por regla de URL para que los ids no creen una serie por recurso.
+metrics = PrometheusMetrics(app, group_by='url_rule')
+metrics.info('presupuestos_nauka_info', 'Servidor de Presupuestos NAUKA')
 
-# ============== RUTAS FRONTEND ==============
+# Directorio para guardar los archivos de cotizaciones subidos
+UPLOAD_FOLDER = Path(__file__).parent / "uploads"
 
-@app.route('/')
-def index():
-    """Servir página principal"""
-    return send_from_directory(app.static_folder, 'index.html')
+def preparar_servidor():
+    """Crear la carpeta de uploads y el esquema de la base (idempotente)"""
+    UPLOAD_FOLDER.mkdir(exist_ok=True)
+    init_database()
+    # Trabajos que dejó a medias un worker anterior (reinicio, timeout, despliegue)
+    marcar_trabajos_abandonados()
+
+# Una vez por proceso, al importar el módulo
+preparar_servidor()
+
+@app.after_request
+def invalidar_cache(response):
+    """Limpiar la cache de lectura cuando una petición modifica datos"""
+    if request.method != 'GET' and request.path.startswith('/api/') and response.status_code < 400:
+        cache.clear()
+    return response
+
+@app.after_request
+def agregar_etag(response):
+    """Agregar ETag a las respuestas GET de la API y responder 304 si no cambiaron"""
+    if (request.method == 'GET' and request.path.startswith('/api/')
+            and response.status_code == 200 and not response.is_streamed):
+        if response.get_etag()[0] is None:
+            response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+        # Obligar al navegador a revalidar siempre con If-None-Match
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+    return response
+
+def cliente_tiene_etag(etag):
+    """
+    Si el If-None-Match de la petición incluye el ETag. flask-compress agrega
+    ':br' / ':gzip' al ETag de las respuestas comprimidas y el navegador lo
+    devuelve así, por lo que se compara sin ese sufijo.
+    """
+    etags = request.if_none_match
+    return etags.contains(etag) or any(tag.partition(':')[0] == etag for tag in etags.as_set())
 
-@app.route('/<path:path>')
-def serve_static(path):
-    """Servir archivos estáticos"""
-    return send_from_directory(app.static_folder, path)
+def etag_por_version(vista):
+    """
+    ETag a partir de la versión de las partidas del proyecto y la URL: si el
+    navegador ya tiene esa versión se responde 304 sin consultar ni serializar.
+    La versión queda en g.version_partidas para las claves de cache de la vista.
+    """
+    @wraps(vista)
+    def envoltura(proyecto_id, **kwargs):
+        version = g.version_partidas = obtener_version_partidas(proyecto_id)
+        etag = hashlib.blake2b(f"{version}:{request.full_path}".encode(), digest_size=16).hexdigest()
+        if cliente_tiene_etag(etag):
+            respuesta = Response(status=304)
+        else:
+            respuesta = app.make_response(vista(proyecto_id, **kwargs))
+        if respuesta.status_code in (200, 304):
+            respuesta.set_etag(etag)
+        return respuesta
+    return envoltura
+
+def clave_cache_version(*args, **kwargs):
+    """
+    Clave de cache por versión de las partidas y URL, para las vistas con
+    etag_por_version. Otro worker, una importación o un trabajo pueden cambiar las
+    partidas sin limpiar esta cache; con la versión en la clave nunca se sirve un
+    cuerpo viejo bajo el ETag de la versión nueva.
+    """
+    return f"v{g.version_partidas}:{request.full_path}"
+
+@app.errorhandler(HTTPException)
+def error_http(e):
+    """Responder los errores HTTP (abort, 404 de rutas, JSON mal formado) como JSON"""
+    return jsonify({'error': e.description}), e.code
+
+@app.errorhandler(Exception)
+def error_inesperado(e):
+    """Registrar la excepción y responder 500 en JSON en lugar de la página HTML de Flask"""
+    app.logger.exception('Error no controlado en %s %s', request.method, request.path)
+    return error_http(InternalServerError(description='Error interno del servidor'))
+
+@app.errorhandler(ValidationError)
+def error_validacion(e):
+    """Responder 400 con el detalle cuando un cuerpo JSON no cumple su esquema"""
+    return jsonify({'error': 'Datos inválidos', 'detalles': e.errors(include_url=False, include_context=False)}), 400
+
+def leer_cuerpo(esquema):
+    """Parsear y validar el cuerpo JSON de la petición con un esquema de esquemas.py"""
+    datos = request.get_json(cache=True)
+    if isinstance(esquema, type):
+        return esquema.model_validate(datos)
+    return esquema.validate_python(datos)
+
+@app.teardown_appcontext
+def liberar_conexion_bd(exc):
+    """Dejar la conexión del hilo sin transacciones pendientes al terminar la petición"""
+    liberar_conexion()
+
+# Tamaño aproximado de cada bloque enviado al cliente en respuestas por streaming
+TAMANO_BLOQUE_STREAM = 64 * 1024
+
+def respuesta_json_stream(filas):
+    """Respuesta con un arreglo JSON que se serializa fila por fila y se envía en bloques"""
+    def generar():
+        bloque = bytearray(b'[')
+        separador = b''
+        for fila in filas:
+            bloque += separador
+            bloque += orjson.dumps(fila)
+            separador = b','
+            # Agrupar filas evita una escritura al socket (y un flush del compresor) por fila
+            if len(bloque) >= TAMANO_BLOQUE_STREAM:
+                yield bytes(bloque)
+                bloque.clear()
+        bloque += b']'
+        yield bytes(bloque)
+    return app.response_class(stream_with_context(generar()), mimetype='application/json')
 
 # ============== API: PROYECTOS ==============
 
 @app.route('/api/proyectos', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_proyectos():
     """Obtener lista de proyectos"""
     proyectos = obtener_proyectos()
     return jsonify(proyectos)
 
 @app.route('/api/proyectos/<int:proyecto_id>', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_proyecto(proyecto_id):
     """Obtener un proyecto específico"""
     proyecto = obtener_proyecto(proyecto_id)
     if proyecto:
         return jsonify(proyecto)
-    return jsonify({'error': 'Proyecto no encontrado'}), 404
+    abort(404, description='Proyecto no encontrado')
 
 @app.route('/api/proyectos', methods=['POST'])
 def api_crear_proyecto():
     """Crear un nuevo proyecto"""
-    datos = request.json
-    nombre = datos.get('nombre')
-    descripcion = datos.get('descripcion', '')
-
-    if not nombre:
-        return jsonify({'error': 'El nombre es requerido'}), 400
+    datos = leer_cuerpo(ProyectoEntrada)
+    nombre, descripcion = datos.nombre, datos.descripcion
 
     proyecto_id = crear_proyecto(nombre, descripcion)
     return jsonify({'id': proyecto_id, 'nombre': nombre, 'descripcion': descripcion})
@@ -94,8 +318,7 @@ def api_obtener_partidas(proyecto_id):
     """Obtener partidas de un proyecto"""
     categoria = request.args.get('categoria')
     concepto = request.args.get('concepto')
-    partidas = obtener_partidas(proyecto_id, categoria, concepto)
-    return jsonify(partidas)
+    return respuesta_json_stream(iter_partidas(proyecto_id, categoria, concepto))
 
 @app.route('/api/partidas/<int:partida_id>', methods=['GET'])
 def api_obtener_partida(partida_id):
@@ -103,22 +326,29 @@ def api_obtener_partida(partida_id):
     partida = obtener_partida(partida_id)
     if partida:
         return jsonify(partida)
-    return jsonify({'error': 'Partida no encontrada'}), 404
+    abort(404, description='Partida no encontrada')
 
 @app.route('/api/proyectos/<int:proyecto_id>/partidas', methods=['POST'])
 def api_crear_partida(proyecto_id):
     """Crear una nueva partida"""
-    datos = request.json
-    partida_id = crear_partida(proyecto_id, datos)
-    partida = obtener_partida(partida_id)
+    datos = leer_cuerpo(PartidaEntrada).model_dump(exclude_unset=True)
+    partida = crear_partida(proyecto_id, datos)
     return jsonify(partida)
 
+@app.route('/api/proyectos/<int:proyecto_id>/partidas/bulk', methods=['POST'])
+def api_crear_partidas_bulk(proyecto_id):
+    """Crear varias partidas en una sola transacción"""
+    lista_datos = [p.model_dump(exclude_unset=True) for p in leer_cuerpo(ListaPartidasEntrada)]
+    ids = crear_partidas_bulk(proyecto_id, lista_datos)
+    return jsonify({'ids': ids})
+
 @app.route('/api/partidas/<int:partida_id>', methods=['PUT'])
 def api_actualizar_partida(partida_id):
     """Actualizar una partida"""
-    datos = request.json
-    actualizar_partida(partida_id, datos)
-    partida = obtener_partida(partida_id)
+    datos = leer_cuerpo(PartidaEntrada).model_dump(exclude_unset=True)
+    partida = actualizar_partida(partida_id, datos)
+    if partida is None:
+        abort(404, description='Partida no encontrada')
     return jsonify(partida)
 
 @app.route('/api/partidas/<int:partida_id>', methods=['DELETE'])
@@ -127,15 +357,32 @@ def api_eliminar_partida(partida_id):
     eliminar_partida(partida_id)
     return jsonify({'success': True})
 
+@app.route('/api/partidas/bulk', methods=['PUT'])
+def api_actualizar_partidas_bulk():
+    """Actualizar varias partidas en una sola transacción"""
+    lista_datos = [p.model_dump(exclude_unset=True) for p in leer_cuerpo(ListaPartidasActualizacionEntrada)]
+    actualizadas = actualizar_partidas_bulk(lista_datos)
+    return jsonify({'actualizadas': actualizadas})
+
+@app.route('/api/partidas/bulk', methods=['DELETE'])
+def api_eliminar_partidas():
+    """Eliminar varias partidas en una sola transacción"""
+    eliminadas = eliminar_partidas(leer_cuerpo(IdsEntrada).ids)
+    return jsonify({'eliminadas': eliminadas})
+
 # ============== API: FILTROS Y GLOSARIO ==============
 
 @app.route('/api/proyectos/<int:proyecto_id>/categorias', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_categorias(proyecto_id):
     """Obtener categorías únicas de un proyecto"""
     categorias = obtener_categorias_proyecto(proyecto_id)
     return jsonify(categorias)
 
 @app.route('/api/proyectos/<int:proyecto_id>/conceptos', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_conceptos(proyecto_id):
     """Obtener conceptos únicos de un proyecto"""
     categoria = request.args.get('categoria')
@@ -145,90 +392,121 @@ def api_obtener_conceptos(proyecto_id):
 # ============== API: RESUMEN ==============
 
 @app.route('/api/proyectos/<int:proyecto_id>/resumen', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_resumen(proyecto_id):
     """Obtener resumen del proyecto"""
     resumen = obtener_resumen_proyecto(proyecto_id)
     return jsonify(resumen)
 
+@lru_cache(maxsize=64)
+def parsear_agrupar_por(agrupar_por_str):
+    """Convertir 'categoria, torre' en ('categoria', 'torre'); el frontend repite pocas combinaciones"""
+    return tuple(c.strip() for c in agrupar_por_str.split(',') if c.strip())
+
+@cache.memoize()
+def resumen_agrupado(proyecto_id, agrupar_por, version):
+    """Resumen agrupado cacheado por proyecto, tupla de campos ya normalizada y versión de las partidas"""
+    return obtener_resumen_agrupado(proyecto_id, agrupar_por)
+
 @app.route('/api/proyectos/<int:proyecto_id>/resumen-agrupado', methods=['GET'])
+@etag_por_version
 def api_obtener_resumen_agrupado(proyecto_id):
     """Obtener resumen agrupado por campos especificados"""
-    agrupar_por_str = request.args.get('agrupar_por', 'categoria')
-    agrupar_por = [c.strip() for c in agrupar_por_str.split(',') if c.strip()]
-    resumen = obtener_resumen_agrupado(proyecto_id, agrupar_por)
+    agrupar_por = parsear_agrupar_por(request.args.get('agrupar_por', 'categoria'))
+    resumen = resumen_agrupado(proyecto_id, agrupar_por, g.version_partidas)
     return jsonify(resumen)
 
 @app.route('/api/proyectos/<int:proyecto_id>/torres', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_torres(proyecto_id):
-    """Obtener torres unicas de un proyecto"""
+    """Obtener torres unicas de un proyecto (obsoleto: usar /filtros)"""
     torres = obtener_torres_proyecto(proyecto_id)
     return jsonify(torres)
 
 @app.route('/api/proyectos/<int:proyecto_id>/pisos', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_pisos(proyecto_id):
-    """Obtener pisos unicos de un proyecto"""
+    """Obtener pisos unicos de un proyecto (obsoleto: usar /filtros)"""
     pisos = obtener_pisos_proyecto(proyecto_id)
     return jsonify(pisos)
 
 @app.route('/api/proyectos/<int:proyecto_id>/proveedores', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_proveedores(proyecto_id):
-    """Obtener proveedores unicos de un proyecto"""
+    """Obtener proveedores unicos de un proyecto (obsoleto: usar /filtros)"""
     proveedores = obtener_proveedores_proyecto(proyecto_id)
     return jsonify(proveedores)
 
 @app.route('/api/proyectos/<int:proyecto_id>/deptos', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
 def api_obtener_deptos(proyecto_id):
-    """Obtener departamentos unicos de un proyecto"""
+    """Obtener departamentos unicos de un proyecto (obsoleto: usar /filtros)"""
     deptos = obtener_deptos_proyecto(proyecto_id)
     return jsonify(deptos)
 
+@app.route('/api/proyectos/<int:proyecto_id>/filtros', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_version)
+def api_obtener_filtros(proyecto_id):
+    """Obtener torres, pisos, proveedores, deptos y categorias de un proyecto en una sola peticion"""
+    filtros = obtener_filtros_proyecto(proyecto_id)
+    return jsonify(filtros)
+
 # ============== API: RESUMEN JERARQUICO ==============
 
+FILTROS_UBICACION = ('torre', 'piso', 'depto')
+
+def filtros_ubicacion():
+    """Filtros torre/piso/depto de la query string como tupla inmutable de (campo, valor).
+    El orden es siempre el de FILTROS_UBICACION, así que sirve tal cual como clave de cache."""
+    args = request.args
+    return tuple((k, v) for k in FILTROS_UBICACION if (v := args.get(k)))
+
+def clave_cache_ubicacion(*args, **kwargs):
+    """Clave de cache por versión de las partidas, ruta y filtros de ubicación, ignorando otros parámetros"""
+    return f"ubicacion:v{g.version_partidas}:{request.path}?{filtros_ubicacion()}"
+
+@cache.memoize()
+def resumen_jerarquico(proyecto_id, filtros, version):
+    """Árbol completo del resumen jerárquico para una tupla de filtros_ubicacion() y una versión de las partidas"""
+    return obtener_resumen_jerarquico(proyecto_id, dict(filtros) or None)
+
+def arbol_jerarquico(proyecto_id):
+    """Obtener el árbol cacheado para el proyecto, los filtros de la petición y la versión actual"""
+    return resumen_jerarquico(proyecto_id, filtros_ubicacion(), g.version_partidas)
+
 @app.route('/api/proyectos/<int:proyecto_id>/resumen-jerarquico', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_ubicacion)
 def api_resumen_jerarquico_nivel1(proyecto_id):
     """Obtener nivel 1 del resumen jerárquico: Categorías"""
-    filtros = {}
-    if request.args.get('torre'):
-        filtros['torre'] = request.args.get('torre')
-    if request.args.get('piso'):
-        filtros['piso'] = request.args.get('piso')
-    if request.args.get('depto'):
-        filtros['depto'] = request.args.get('depto')
-
-    resumen = obtener_resumen_jerarquico_nivel1(proyecto_id, filtros if filtros else None)
-    return jsonify(resumen)
+    return jsonify(arbol_jerarquico(proyecto_id)['nivel1'])
 
 @app.route('/api/proyectos/<int:proyecto_id>/resumen-jerarquico/categoria/<path:categoria>', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_ubicacion)
 def api_resumen_jerarquico_nivel2(proyecto_id, categoria):
     """Obtener nivel 2 del resumen jerárquico: Conceptos de una categoría"""
-    filtros = {}
-    if request.args.get('torre'):
-        filtros['torre'] = request.args.get('torre')
-    if request.args.get('piso'):
-        filtros['piso'] = request.args.get('piso')
-    if request.args.get('depto'):
-        filtros['depto'] = request.args.get('depto')
-
-    resumen = obtener_resumen_jerarquico_nivel2(proyecto_id, categoria, filtros if filtros else None)
-    return jsonify(resumen)
+    conceptos = arbol_jerarquico(proyecto_id)['nivel2'].get(categoria, [])
+    return jsonify({'conceptos': conceptos})
 
 @app.route('/api/proyectos/<int:proyecto_id>/resumen-jerarquico/categoria/<path:categoria>/concepto/<path:concepto>', methods=['GET'])
+@etag_por_version
+@cache.cached(make_cache_key=clave_cache_ubicacion)
 def api_resumen_jerarquico_nivel3(proyecto_id, categoria, concepto):
     """Obtener nivel 3 del resumen jerárquico: Detalles de un concepto"""
-    filtros = {}
-    if request.args.get('torre'):
-        filtros['torre'] = request.args.get('torre')
-    if request.args.get('piso'):
-        filtros['piso'] = request.args.get('piso')
-    if request.args.get('depto'):
-        filtros['depto'] = request.args.get('depto')
-
-    resumen = obtener_resumen_jerarquico_nivel3(proyecto_id, categoria, concepto, filtros if filtros else None)
-    return jsonify(resumen)
+    detalles = arbol_jerarquico(proyecto_id)['nivel3'].get((categoria, concepto), [])
+    return jsonify({'detalles': detalles})
 
 # ============== API: TIPOS DE CAMBIO ==============
 
 @app.route('/api/tipos-cambio', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_tipos_cambio():
     """Obtener tipos de cambio"""
     tipos = obtener_tipos_cambio()
@@ -237,19 +515,14 @@ def api_obtener_tipos_cambio():
 @app.route('/api/tipos-cambio', methods=['POST'])
 def api_actualizar_tipo_cambio():
     """Actualizar un tipo de cambio"""
-    datos = request.json
-    moneda = datos.get('moneda')
-    valor = datos.get('valor')
-
-    if not moneda or valor is None:
-        return jsonify({'error': 'Moneda y valor son requeridos'}), 400
-
-    actualizar_tipo_cambio(moneda, float(valor))
+    datos = leer_cuerpo(TipoCambioEntrada)
+    actualizar_tipo_cambio(datos.moneda, datos.valor)
     return jsonify({'success': True})
 
 # ============== API: GLOSARIO ==============
 
 @app.route('/api/proyectos/<int:proyecto_id>/glosario', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_glosario(proyecto_id):
     """Obtener glosario completo del proyecto"""
     glosario = obtener_glosario_proyecto(proyecto_id)
@@ -258,16 +531,11 @@ def api_obtener_glosario(proyecto_id):
 @app.route('/api/proyectos/<int:proyecto_id>/glosario/categorias', methods=['POST'])
 def api_agregar_categoria_glosario(proyecto_id):
     """Agregar una categoría al glosario"""
-    datos = request.json
-    nombre = datos.get('nombre')
-
-    if not nombre or not nombre.strip():
-        return jsonify({'error': 'El nombre es requerido'}), 400
-
+    nombre = leer_cuerpo(NombreEntrada).nombre
     resultado = agregar_categoria_glosario(proyecto_id, nombre)
     if resultado:
         return jsonify(resultado)
-    return jsonify({'error': 'La categoría ya existe'}), 409
+    abort(409, description='La categoría ya existe')
 
 @app.route('/api/glosario/categorias/<int:categoria_id>', methods=['DELETE'])
 def api_eliminar_categoria_glosario(categoria_id):
@@ -278,16 +546,11 @@ def api_eliminar_categoria_glosario(categoria_id):
 @app.route('/api/glosario/categorias/<int:categoria_id>/conceptos', methods=['POST'])
 def api_agregar_concepto_glosario(categoria_id):
     """Agregar un concepto a una categoría"""
-    datos = request.json
-    nombre = datos.get('nombre')
-
-    if not nombre or not nombre.strip():
-        return jsonify({'error': 'El nombre es requerido'}), 400
-
+    nombre = leer_cuerpo(NombreEntrada).nombre
     resultado = agregar_concepto_glosario(categoria_id, nombre)
     if resultado:
         return jsonify(resultado)
-    return jsonify({'error': 'El concepto ya existe en esta categoría'}), 409
+    abort(409, description='El concepto ya existe en esta categoría')
 
 @app.route('/api/glosario/conceptos/<int:concepto_id>', methods=['DELETE'])
 def api_eliminar_concepto_glosario(concepto_id):
@@ -301,46 +564,71 @@ def api_importar_glosario(proyecto_id):
     resultado = importar_glosario_desde_partidas(proyecto_id)
     return jsonify(resultado)
 
+# Las importaciones de Excel son lentas y usan CPU: se ejecutan en un proceso aparte
+# ('spawn' para no heredar conexiones SQLite abiertas del proceso web)
+executor_trabajos = ProcessPoolExecutor(
+    max_workers=1,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=models.usar_base_datos,
+    initargs=(models.DATABASE_PATH,),
+)
+
+def encolar_trabajo(tipo, funcion, *args):
+    """Ejecutar una función en el pool de trabajos y devolver el id para consultar su estado"""
+    trabajo_id = uuid.uuid4().hex
+    crear_trabajo(trabajo_id, tipo)
+
+    def al_terminar(futuro):
+        try:
+            resultado = futuro.result()
+            estado = 'error' if 'error' in resultado else 'completado'
+        except Exception as e:
+            resultado, estado = {'error': str(e)}, 'error'
+        finalizar_trabajo(trabajo_id, estado, resultado)
+        cache.clear()
+
+    executor_trabajos.submit(ejecutar_trabajo, trabajo_id, funcion, *args).add_done_callback(al_terminar)
+    return trabajo_id
+
 @app.route('/api/proyectos/<int:proyecto_id>/glosario/importar-excel', methods=['POST'])
 def api_importar_glosario_excel(proyecto_id):
-    """Importar glosario desde el archivo Excel del proyecto"""
+    """Encolar la importación del glosario desde el archivo Excel del proyecto"""
     # Obtener el proyecto para saber qué archivo usar
     proyecto = obtener_proyecto(proyecto_id)
     if not proyecto:
-        return jsonify({'error': 'Proyecto no encontrado'}), 404
+        abort(404, description='Proyecto no encontrado')
 
     # Mapear proyecto a archivo Excel
-    nombre_proyecto = proyecto['nombre'].lower()
-    archivo_excel = None
-
-    if 'beachfront' in nombre_proyecto:
-        archivo_excel = EXCEL_PATH / "IZ - NAUKA PPTO Beachfront 170125.xlsx"
-    elif 'lote 3' in nombre_proyecto or 'lote3' in nombre_proyecto:
-        archivo_excel = EXCEL_PATH / "IZ - NAUKA PPTO Lote 3 170126.xlsx"
-    elif 'lote 44' in nombre_proyecto or 'lote44' in nombre_proyecto:
-        archivo_excel = EXCEL_PATH / "IZ - NAUKA PPTO Lote 44 170126.xlsx"
-    elif 'golf' in nombre_proyecto:
-        archivo_excel = EXCEL_PATH / "NAUKA - PPTO Casas Golf 281025.xlsx"
+    archivo_excel = archivo_excel_proyecto(proyecto['nombre'])
 
+    # La carpeta se sincroniza con iCloud: comprobar existencia en cada importación
     if not archivo_excel or not archivo_excel.exists():
-        return jsonify({'error': f'No se encontró archivo Excel para el proyecto: {proyecto["nombre"]}'}), 404
+        abort(404, description=f'No se encontró archivo Excel para el proyecto: {proyecto["nombre"]}')
 
-    resultado = importar_glosario_desde_excel(proyecto_id, str(archivo_excel))
+    trabajo_id = encolar_trabajo('importar_glosario', importar_glosario_desde_excel, proyecto_id, str(archivo_excel))
+    return jsonify({'trabajo_id': trabajo_id}), 202
 
-    if 'error' in resultado:
-        return jsonify(resultado), 400
+# ============== API: TRABAJOS EN SEGUNDO PLANO ==============
 
-    return jsonify(resultado)
+@app.route('/api/trabajos/<trabajo_id>', methods=['GET'])
+def api_obtener_trabajo(trabajo_id):
+    """Consultar el estado de un trabajo en segundo plano"""
+    trabajo = obtener_trabajo(trabajo_id)
+    if not trabajo:
+        abort(404, description='Trabajo no encontrado')
+    return jsonify(trabajo)
 
 # ============== API: GLOSARIO GLOBAL DE PROVEEDORES ==============
 
 @app.route('/api/proveedores-global', methods=['GET'])
+@cache.cached(query_string=True)
 def api_proveedores_global():
     """Obtener glosario global de proveedores por categoría (todos los proyectos)"""
     proveedores = obtener_proveedores_por_categoria_global()
     return jsonify(proveedores)
 
 @app.route('/api/proveedores-global/<path:proveedor>/estadisticas', methods=['GET'])
+@cache.cached(query_string=True)
 def api_estadisticas_proveedor(proveedor):
     """Obtener estadísticas de un proveedor específico"""
     stats = obtener_estadisticas_proveedor(proveedor)
@@ -348,11 +636,8 @@ def api_estadisticas_proveedor(proveedor):
 
 # ============== API: COTIZACIONES ==============
 
-# Directorio para guardar PDFs subidos
-UPLOAD_FOLDER = Path(__file__).parent / "uploads"
-UPLOAD_FOLDER.mkdir(exist_ok=True)
-
 @app.route('/api/cotizaciones', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_cotizaciones():
     """Obtener lista de cotizaciones con filtros opcionales"""
     proyecto_id = request.args.get('proyecto_id', type=int)
@@ -363,29 +648,42 @@ def api_obtener_cotizaciones():
     return jsonify(cotizaciones)
 
 @app.route('/api/cotizaciones/<int:cotizacion_id>', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_cotizacion(cotizacion_id):
     """Obtener una cotización específica"""
     cotizacion = obtener_cotizacion(cotizacion_id)
     if cotizacion:
         return jsonify(cotizacion)
-    return jsonify({'error': 'Cotización no encontrada'}), 404
+    abort(404, description='Cotización no encontrada')
+
+# Tamaño de los bloques al copiar un archivo subido a disco
+TAMANO_BLOQUE_UPLOAD = 1 << 20
+
+def guardar_archivo_con_hash(archivo, destino):
+    """Copiar el archivo subido a disco por bloques y devolver su SHA-256 (sin cargarlo en memoria)"""
+    sha256 = hashlib.sha256()
+    with open(destino, 'wb') as f:
+        while bloque := archivo.stream.read(TAMANO_BLOQUE_UPLOAD):
+            sha256.update(bloque)
+            f.write(bloque)
+    return sha256.hexdigest()
 
 @app.route('/api/cotizaciones/upload', methods=['POST'])
 def api_subir_cotizacion():
     """
-    Subir y procesar un archivo Excel de cotizacion.
+    Subir un archivo Excel de cotizacion y encolar su procesamiento.
     Solo acepta archivos .xlsx y .xls (PDFs ya no son soportados).
+    Responde 202 con el trabajo_id para consultar en /api/trabajos/<id>.
     """
-    import traceback
-    print("=== INICIO UPLOAD COTIZACION ===")
+    app.logger.debug('Inicio upload cotizacion')
 
     # Verificar que hay archivo
     if 'archivo' not in request.files:
-        return jsonify({'error': 'No se envió archivo'}), 400
+        abort(400, description='No se envió archivo')
 
     archivo = request.files['archivo']
     if archivo.filename == '':
-        return jsonify({'error': 'Nombre de archivo vacío'}), 400
+        abort(400, description='Nombre de archivo vacío')
 
     # Verificar extension permitida - SOLO EXCEL (PDF ya no es soportado)
     nombre_lower = archivo.filename.lower()
@@ -401,88 +699,55 @@ def api_subir_cotizacion():
         }), 400
 
     if not es_excel:
-        return jsonify({'error': 'Solo se permiten archivos Excel (.xlsx, .xls)'}), 400
+        abort(400, description='Solo se permiten archivos Excel (.xlsx, .xls)')
 
     # Obtener datos del formulario
     proyecto_id = request.form.get('proyecto_id', type=int)
     proveedor = request.form.get('proveedor', '').strip()
     categorias = request.form.getlist('categorias[]')  # Lista de categorías
-    if not categorias:
-        # Intentar obtener como JSON string
-        categorias_str = request.form.get('categorias', '')
-        if categorias_str:
-            import json
-            try:
-                categorias = json.loads(categorias_str)
-            except:
-                categorias = [categorias_str] if categorias_str else []
+    if not categorias and (categorias_str := request.form.get('categorias')):
+        # El frontend las envía como JSON; un texto plano se toma como una sola categoría
+        try:
+            categorias = orjson.loads(categorias_str)
+        except orjson.JSONDecodeError:
+            categorias = [categorias_str]
+        if isinstance(categorias, str):
+            categorias = [categorias]
 
     fecha_cotizacion = request.form.get('fecha_cotizacion')
     moneda = request.form.get('moneda', 'MXN')
     notas = request.form.get('notas', '')
 
     if not proyecto_id:
-        return jsonify({'error': 'proyecto_id es requerido'}), 400
+        abort(400, description='proyecto_id es requerido')
     if not proveedor:
-        return jsonify({'error': 'proveedor es requerido'}), 400
-
-    try:
-        # Leer bytes del archivo
-        print(f"Leyendo archivo: {archivo.filename}")
-        file_bytes = archivo.read()
-        print(f"Bytes leidos: {len(file_bytes)}")
-
-        # Procesar archivo Excel
-        print("Procesando archivo Excel...")
-        resultado = extraer_items_excel_bytes(file_bytes, archivo.filename)
-
-        print(f"Resultado: {len(resultado.get('items', []))} items, {len(resultado.get('errores', []))} errores")
-
-        if resultado['errores'] and not resultado['items']:
-            print(f"Errores encontrados: {resultado['errores'][:3]}")
-            return jsonify({
-                'error': 'Error procesando Excel',
-                'detalles': resultado['errores']
-            }), 500
-
-        # Crear la cotización en la base de datos
-        cotizacion_id = crear_cotizacion(
-            proyecto_id=proyecto_id,
-            proveedor=proveedor,
-            categorias=categorias,
-            archivo_nombre=archivo.filename,
-            fecha_cotizacion=fecha_cotizacion,
-            moneda=moneda,
-            notas=notas
-        )
-
-        # Guardar los items extraídos
-        if resultado['items']:
-            # Agregar moneda a cada item
-            for item in resultado['items']:
-                item['moneda'] = moneda
-            crear_items_cotizacion(cotizacion_id, resultado['items'])
-
-        # Guardar copia del archivo Excel
-        ext = '.xlsx' if archivo.filename.lower().endswith('.xlsx') else '.xls'
-        archivo_path = UPLOAD_FOLDER / f"cotizacion_{cotizacion_id}{ext}"
-        with open(archivo_path, 'wb') as f:
-            f.write(file_bytes)
-
-        # Obtener la cotización creada
-        cotizacion = obtener_cotizacion(cotizacion_id)
-
-        return jsonify({
-            'cotizacion': cotizacion,
-            'items': resultado['items'],
-            'num_paginas': resultado['num_paginas'],
-            'errores': resultado['errores']
-        })
-
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        abort(400, description='proveedor es requerido')
+
+    # Guardar el archivo y procesarlo en el pool de trabajos (la lectura del Excel es lenta)
+    ext = '.xlsx' if nombre_lower.endswith('.xlsx') else '.xls'
+    archivo_path = UPLOAD_FOLDER / f"pendiente_{uuid.uuid4().hex}{ext}"
+    archivo_hash = guardar_archivo_con_hash(archivo, archivo_path)
+    app.logger.info('Archivo guardado: %s -> %s', archivo.filename, archivo_path.name)
+
+    # Mismo archivo ya cargado para este proyecto y proveedor: devolver esa cotización
+    cotizacion_id = buscar_cotizacion_por_hash(proyecto_id, proveedor, archivo_hash)
+    if cotizacion_id:
+        archivo_path.unlink()
+        trabajo_id = uuid.uuid4().hex
+        crear_trabajo(trabajo_id, 'procesar_cotizacion')
+        finalizar_trabajo(trabajo_id, 'completado', resultado_cotizacion_duplicada(cotizacion_id))
+        return jsonify({'trabajo_id': trabajo_id}), 202
+
+    trabajo_id = encolar_trabajo('procesar_cotizacion', procesar_cotizacion_excel, str(archivo_path), archivo.filename, {
+        'proyecto_id': proyecto_id,
+        'proveedor': proveedor,
+        'categorias': categorias,
+        'fecha_cotizacion': fecha_cotizacion,
+        'moneda': moneda,
+        'notas': notas,
+        'archivo_hash': archivo_hash
+    })
+    return jsonify({'trabajo_id': trabajo_id}), 202
 
 @app.route('/api/cotizaciones/<int:cotizacion_id>', methods=['PUT'])
 def api_actualizar_cotizacion(cotizacion_id):
@@ -504,6 +769,7 @@ def api_eliminar_cotizacion(cotizacion_id):
     return jsonify({'success': True})
 
 @app.route('/api/cotizaciones/<int:cotizacion_id>/items', methods=['GET'])
+@cache.cached(query_string=True)
 def api_obtener_items_cotizacion(cotizacion_id):
     """Obtener items de una cotización"""
     items = obtener_items_cotizacion(cotizacion_id)
@@ -525,12 +791,14 @@ def api_eliminar_item_cotizacion(item_id):
 # ============== API: COMPARACION DE UNITARIOS ==============
 
 @app.route('/api/cotizaciones/proveedores', methods=['GET'])
+@cache.cached(query_string=True)
 def api_proveedores_cotizaciones():
     """Obtener lista de proveedores que tienen cotizaciones"""
     proveedores = obtener_proveedores_cotizaciones()
     return jsonify(proveedores)
 
 @app.route('/api/comparar-unitarios', methods=['GET'])
+@cache.cached(query_string=True)
 def api_comparar_unitarios():
     """
     Comparar precios unitarios de un proveedor entre proyectos.
@@ -540,7 +808,7 @@ def api_comparar_unitarios():
     categoria = request.args.get('categoria')
 
     if not proveedor:
-        return jsonify({'error': 'proveedor es requerido'}), 400
+        abort(400, description='proveedor es requerido')
 
     resultado = comparar_unitarios(proveedor, categoria)
     return jsonify(resultado)
@@ -553,6 +821,8 @@ if __name__ == '__main__':
     print("="*60)
     print("Iniciando servidor en http://localhost:5000")
     print("Presiona Ctrl+C para detener")
+    print("Servidor de desarrollo: en producción usar gunicorn (ver Procfile)")
     print("="*60 + "\n")
 
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Debug solo si se pide explícitamente con FLASK_DEBUG=1
+    app.run(debug=app.debug, threaded=True, host='0.0.0.0', port=5000)
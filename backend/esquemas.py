@@ -0,0 +1,60 @@
+"""
+Esquemas de validación para los cuerpos JSON de la API
+"""
+from typing import Annotated, Optional
+
+from pydantic import BaseModel, StringConstraints, TypeAdapter
+
+# Texto obligatorio: se recortan espacios y no puede quedar vacío
+Nombre = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+
+class ProyectoEntrada(BaseModel):
+    nombre: Nombre
+    descripcion: str = ''
+
+
+class PartidaEntrada(BaseModel):
+    """Campos editables de una partida (los totales se calculan en models)"""
+    categoria: Optional[str] = None
+    concepto: Optional[str] = None
+    detalle: Optional[str] = None
+    proveedor: Optional[str] = None
+    unidad: Optional[str] = None
+    cantidad: Optional[float] = None
+    moneda: Optional[str] = None
+    unitario: Optional[float] = None
+    sobrecosto_pct: Optional[float] = None
+    iva_pct: Optional[float] = None
+    tipo_cambio: Optional[float] = None
+    notas: Optional[str] = None
+    es_parametro: Optional[str] = None
+    torre: Optional[str] = None
+    piso: Optional[str] = None
+    depto: Optional[str] = None
+
+
+ListaPartidasEntrada = TypeAdapter(list[PartidaEntrada])
+
+
+class PartidaActualizacionEntrada(PartidaEntrada):
+    """Partida de una actualización masiva: los mismos campos más su id"""
+    id: int
+
+
+ListaPartidasActualizacionEntrada = TypeAdapter(list[PartidaActualizacionEntrada])
+
+
+class IdsEntrada(BaseModel):
+    """Cuerpo de los borrados masivos"""
+    ids: list[int]
+
+
+class TipoCambioEntrada(BaseModel):
+    moneda: Nombre
+    valor: float
+
+
+class NombreEntrada(BaseModel):
+    """Cuerpo de las altas de categorías y conceptos del glosario"""
+    nombre: Nombre
@@ -1,17 +1,24 @@
 """
 Script para importar archivos Excel de presupuestos NAUKA a la base de datos
 """
+import openpyxl
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import multiprocessing
+import os
 from pathlib import Path
+import sqlite3
 import sys
 import re
 
 # Agregar el directorio actual al path para importar models
 sys.path.insert(0, str(Path(__file__).parent))
 
+import models
 from models import (
-    init_database, get_connection, crear_proyecto,
-    obtener_proyectos
+    init_database, get_connection, transaccion, crear_proyecto,
+    obtener_proyectos, usar_base_datos
 )
 
 # Ruta a los archivos Excel
@@ -25,24 +32,129 @@ ARCHIVOS_PROYECTOS = {
     "IZ - NAUKA PPTO Beachfront 170125.xlsx": "Beachfront"
 }
 
-def limpiar_valor(valor):
-    """Limpiar y convertir valores del Excel"""
-    if pd.isna(valor) or valor is None:
-        return None
-    if isinstance(valor, str):
-        valor = valor.strip()
-        if valor in ['', 'S/D', 's/d', 'N/A', 'n/a', '-']:
-            return None
-    return valor
-
-def limpiar_numero(valor):
-    """Convertir valor a número, manejando errores"""
-    if pd.isna(valor) or valor is None:
-        return 0
+# Celda que identifica la fila de encabezados de la hoja BD
+ENCABEZADOS_CATEGORIA = frozenset({'CATEGORIA', 'CATEGORÍA'})
+
+# Encabezado exacto de la hoja BD -> campo de partidas
+ALIAS_ENCABEZADOS = {
+    'CONCEPTO': 'concepto',
+    'DETALLE': 'detalle',
+    'PROVEEDOR': 'proveedor',
+    'UNIDAD': 'unidad',
+    'CANTIDAD': 'cantidad',
+    'MONEDA': 'moneda',
+    'SOBRECOSTO': 'sobrecosto_pct',
+    '% SOBRECOSTO': 'sobrecosto_pct',
+    '% IVA': 'iva_pct',
+    '$ IVA': 'iva_monto',
+    'T.C': 'tipo_cambio',
+    'T.C.': 'tipo_cambio',
+    'TC': 'tipo_cambio',
+    'TIPO CAMBIO': 'tipo_cambio',
+    'NOTAS': 'notas',
+    'TORRE': 'torre',
+    'PISO': 'piso',
+    'DEPTO': 'depto',
+    'DEPARTAMENTO': 'depto',
+}
+
+# Si no hay alias exacto: fragmento contenido en el encabezado -> campo (en orden)
+FRAGMENTOS_ENCABEZADOS = (
+    ('CATEGORIA', 'categoria'),
+    ('CATEGORÍA', 'categoria'),
+    ('UNITARIO', 'unitario'),
+    ('IMPORTE SIN IVA', 'importe_sin_iva'),
+    ('TOTAL SOBRECOSTO', 'sobrecosto_monto'),
+    ('IMPORTE TOTAL', 'importe_total'),
+    ('TOTAL MXN', 'total_mxn'),
+    ('PARAMETR', 'es_parametro'),
+    ('PPTO', 'es_parametro'),
+)
+
+# Textos del Excel que significan "sin dato"
+VALORES_VACIOS = frozenset({'', 'S/D', 's/d', 'N/A', 'n/a', '-'})
+
+# Columnas que se convierten a número antes de recorrer las filas
+CAMPOS_NUMERICOS = (
+    'cantidad', 'unitario', 'importe_sin_iva', 'sobrecosto_pct', 'sobrecosto_monto',
+    'iva_pct', 'iva_monto', 'importe_total', 'tipo_cambio', 'total_mxn'
+)
+
+# Filas que se leen, limpian e insertan juntas: acota la memoria en hojas muy grandes
+TAMANO_LOTE = 10000
+
+COLUMNAS_PARTIDA = """
+    proyecto_id, categoria, concepto, detalle, proveedor, unidad,
+    cantidad, moneda, unitario, importe_sin_iva, sobrecosto_pct,
+    sobrecosto_monto, iva_pct, iva_monto, importe_total, tipo_cambio,
+    total_mxn, notas, es_parametro, torre, piso, depto
+"""
+
+CAMPOS_PARTIDA = tuple(campo.strip() for campo in COLUMNAS_PARTIDA.split(','))
+
+# Valor de cada campo cuando la columna no existe o viene vacía (texto '' y número 0
+# salvo estos); un tipo de cambio 0 también se toma como vacío
+VALORES_DEFECTO = {'moneda': 'MXN', 'es_parametro': 'PRESUPUESTO', 'tipo_cambio': 1}
+
+# Las filas se cargan primero en una tabla temporal y después pasan a partidas
+# con un solo INSERT ... SELECT
+SQL_CREAR_CARGA = f"CREATE TEMP TABLE partidas_carga AS SELECT {COLUMNAS_PARTIDA} FROM partidas WHERE 0"
+SQL_INSERTAR_PARTIDA = f"""
+    INSERT INTO partidas_carga ({COLUMNAS_PARTIDA})
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_PASAR_CARGA = f"INSERT INTO partidas ({COLUMNAS_PARTIDA}) SELECT {COLUMNAS_PARTIDA} FROM partidas_carga"
+
+def leer_hoja(archivo_path, hoja):
+    """Filas de una hoja como tuplas de valores, leídas en streaming con openpyxl"""
+    libro = openpyxl.load_workbook(archivo_path, read_only=True, data_only=True)
     try:
-        return float(valor)
-    except (ValueError, TypeError):
-        return 0
+        yield from libro[hoja].iter_rows(values_only=True)
+    finally:
+        libro.close()
+
+def limpiar_texto(columna):
+    """Recortar espacios de una columna; vacíos y marcadores como 'S/D' quedan en None"""
+    texto = columna.astype('string').str.strip()
+    texto = texto.mask(texto.isin(VALORES_VACIOS))
+    return texto.astype(object).where(texto.notna(), None)
+
+def limpiar_numero(columna):
+    """Convertir una columna a número; vacíos y valores no numéricos quedan en 0"""
+    return pd.to_numeric(columna, errors='coerce').fillna(0)
+
+def limpiar_bloque(bloque, col_map):
+    """
+    Convertir y limpiar de una vez las columnas mapeadas de un bloque de filas,
+    descartando las filas vacías o sin categoría
+    """
+    if 'categoria' not in col_map:
+        return bloque.iloc[:0]
+    bloque = bloque[limpiar_texto(bloque[col_map['categoria']]).notna()].copy()
+    columnas_numericas = [col_map[campo] for campo in CAMPOS_NUMERICOS if campo in col_map]
+    if columnas_numericas:
+        bloque[columnas_numericas] = bloque[columnas_numericas].apply(limpiar_numero)
+    columnas_texto = [idx for campo, idx in col_map.items() if campo not in CAMPOS_NUMERICOS]
+    if columnas_texto:
+        bloque[columnas_texto] = bloque[columnas_texto].apply(limpiar_texto)
+    return bloque
+
+def filas_partidas(bloque, col_map, proyecto_id):
+    """
+    Armar por columnas los valores a insertar (en el orden de COLUMNAS_PARTIDA) y
+    devolver pares (fila del Excel, tupla de valores)
+    """
+    columnas = {'proyecto_id': proyecto_id}
+    for campo in CAMPOS_PARTIDA[1:]:
+        defecto = VALORES_DEFECTO.get(campo, 0 if campo in CAMPOS_NUMERICOS else '')
+        if campo not in col_map:
+            columnas[campo] = defecto
+            continue
+        valores = bloque[col_map[campo]]
+        vacios = valores == 0 if campo == 'tipo_cambio' else valores.isna()
+        columnas[campo] = valores.mask(vacios, defecto)
+    tabla = pd.DataFrame(columnas, index=bloque.index, columns=CAMPOS_PARTIDA).astype(object)
+    return list(zip(tabla.index, tabla.itertuples(index=False, name=None)))
 
 def importar_excel(archivo_path, nombre_proyecto):
     """Importar un archivo Excel a la base de datos"""
@@ -51,77 +163,38 @@ def importar_excel(archivo_path, nombre_proyecto):
     print(f"Archivo: {archivo_path.name}")
     print('='*60)
 
-    # Leer el archivo Excel, hoja BD
+    # Leer la hoja BD en streaming (sólo lectura, valores calculados, sin estilos):
+    # las filas se procesan por bloques sin cargar la hoja completa en memoria
+    filas = leer_hoja(archivo_path, "BD")
+
+    # Encontrar la fila de encabezados (buscar "CATEGORÍA" o "CATEGORIA")
+    header_row = None
     try:
-        df = pd.read_excel(archivo_path, sheet_name="BD", header=None)
+        for idx, row in enumerate(filas):
+            if any(isinstance(v, str) and v.strip().upper() in ENCABEZADOS_CATEGORIA for v in row):
+                header_row = idx
+                headers = list(row)
+                break
     except Exception as e:
         print(f"Error al leer el archivo: {e}")
         return False
 
-    # Encontrar la fila de encabezados (buscar "CATEGORÍA" o "CATEGORIA")
-    header_row = None
-    for idx, row in df.iterrows():
-        row_values = [str(v).upper() if pd.notna(v) else '' for v in row.values]
-        if 'CATEGORIA' in row_values or 'CATEGORÍA' in row_values:
-            header_row = idx
-            break
-
     if header_row is None:
         print("No se encontró la fila de encabezados")
         return False
 
     print(f"Fila de encabezados encontrada: {header_row + 1}")
 
-    # Obtener los encabezados
-    headers = df.iloc[header_row].tolist()
-
     # Mapear columnas por nombre (buscar índices)
     col_map = {}
     for idx, h in enumerate(headers):
-        if pd.notna(h):
+        if h is not None:
             h_upper = str(h).upper().strip()
-            if 'CATEGORIA' in h_upper or 'CATEGORÍA' in h_upper:
-                col_map['categoria'] = idx
-            elif h_upper == 'CONCEPTO':
-                col_map['concepto'] = idx
-            elif h_upper == 'DETALLE':
-                col_map['detalle'] = idx
-            elif h_upper == 'PROVEEDOR':
-                col_map['proveedor'] = idx
-            elif h_upper == 'UNIDAD':
-                col_map['unidad'] = idx
-            elif h_upper == 'CANTIDAD':
-                col_map['cantidad'] = idx
-            elif h_upper == 'MONEDA':
-                col_map['moneda'] = idx
-            elif 'UNITARIO' in h_upper:
-                col_map['unitario'] = idx
-            elif 'IMPORTE SIN IVA' in h_upper:
-                col_map['importe_sin_iva'] = idx
-            elif h_upper == 'SOBRECOSTO' or h_upper == '% SOBRECOSTO':
-                col_map['sobrecosto_pct'] = idx
-            elif 'TOTAL SOBRECOSTO' in h_upper:
-                col_map['sobrecosto_monto'] = idx
-            elif h_upper == '% IVA':
-                col_map['iva_pct'] = idx
-            elif h_upper == '$ IVA':
-                col_map['iva_monto'] = idx
-            elif 'IMPORTE TOTAL' in h_upper:
-                col_map['importe_total'] = idx
-            elif h_upper in ['T.C', 'T.C.', 'TC', 'TIPO CAMBIO']:
-                col_map['tipo_cambio'] = idx
-            elif 'TOTAL MXN' in h_upper:
-                col_map['total_mxn'] = idx
-            elif h_upper == 'NOTAS':
-                col_map['notas'] = idx
-            elif 'PARAMETR' in h_upper or 'PPTO' in h_upper:
-                col_map['es_parametro'] = idx
-            elif h_upper == 'TORRE':
-                col_map['torre'] = idx
-            elif h_upper == 'PISO':
-                col_map['piso'] = idx
-            elif h_upper == 'DEPTO' or h_upper == 'DEPARTAMENTO':
-                col_map['depto'] = idx
+            campo = ALIAS_ENCABEZADOS.get(h_upper) or next(
+                (campo for fragmento, campo in FRAGMENTOS_ENCABEZADOS if fragmento in h_upper), None
+            )
+            if campo:
+                col_map[campo] = idx
 
     print(f"Columnas mapeadas: {list(col_map.keys())}")
 
@@ -129,100 +202,66 @@ def importar_excel(archivo_path, nombre_proyecto):
     proyecto_id = crear_proyecto(nombre_proyecto, f"Importado desde {archivo_path.name}")
     print(f"Proyecto ID: {proyecto_id}")
 
-    # Limpiar partidas existentes del proyecto
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM partidas WHERE proyecto_id = ?", (proyecto_id,))
-    conn.commit()
 
     # Importar datos (desde la fila después de los encabezados)
     partidas_importadas = 0
     partidas_error = 0
 
-    for idx in range(header_row + 1, len(df)):
-        row = df.iloc[idx]
-
-        # Saltar filas vacías o sin categoría
-        categoria = limpiar_valor(row.iloc[col_map.get('categoria', 1)] if 'categoria' in col_map else None)
-        if not categoria:
-            continue
+    def registrar_error(idx, e):
+        nonlocal partidas_error
+        partidas_error += 1
+        if partidas_error <= 5:  # Solo mostrar primeros 5 errores
+            print(f"  Error en fila {idx + 1}: {e}")
 
+    def insertar_lote(filas):
+        """Insertar un lote con executemany; si alguna fila falla, repetirlo fila por fila"""
+        nonlocal partidas_importadas
+        cursor.execute("SAVEPOINT lote")
         try:
-            # Extraer datos de la fila
-            datos = {
-                'categoria': categoria,
-                'concepto': limpiar_valor(row.iloc[col_map['concepto']]) if 'concepto' in col_map else '',
-                'detalle': limpiar_valor(row.iloc[col_map['detalle']]) if 'detalle' in col_map else '',
-                'proveedor': limpiar_valor(row.iloc[col_map['proveedor']]) if 'proveedor' in col_map else '',
-                'unidad': limpiar_valor(row.iloc[col_map['unidad']]) if 'unidad' in col_map else '',
-                'cantidad': limpiar_numero(row.iloc[col_map['cantidad']]) if 'cantidad' in col_map else 0,
-                'moneda': limpiar_valor(row.iloc[col_map['moneda']]) if 'moneda' in col_map else 'MXN',
-                'unitario': limpiar_numero(row.iloc[col_map['unitario']]) if 'unitario' in col_map else 0,
-                'importe_sin_iva': limpiar_numero(row.iloc[col_map['importe_sin_iva']]) if 'importe_sin_iva' in col_map else 0,
-                'sobrecosto_pct': limpiar_numero(row.iloc[col_map['sobrecosto_pct']]) if 'sobrecosto_pct' in col_map else 0,
-                'sobrecosto_monto': limpiar_numero(row.iloc[col_map['sobrecosto_monto']]) if 'sobrecosto_monto' in col_map else 0,
-                'iva_pct': limpiar_numero(row.iloc[col_map['iva_pct']]) if 'iva_pct' in col_map else 0,
-                'iva_monto': limpiar_numero(row.iloc[col_map['iva_monto']]) if 'iva_monto' in col_map else 0,
-                'importe_total': limpiar_numero(row.iloc[col_map['importe_total']]) if 'importe_total' in col_map else 0,
-                'tipo_cambio': limpiar_numero(row.iloc[col_map['tipo_cambio']]) if 'tipo_cambio' in col_map else 1,
-                'total_mxn': limpiar_numero(row.iloc[col_map['total_mxn']]) if 'total_mxn' in col_map else 0,
-                'notas': limpiar_valor(row.iloc[col_map['notas']]) if 'notas' in col_map else '',
-                'es_parametro': limpiar_valor(row.iloc[col_map['es_parametro']]) if 'es_parametro' in col_map else 'PRESUPUESTO',
-                'torre': limpiar_valor(row.iloc[col_map['torre']]) if 'torre' in col_map else '',
-                'piso': limpiar_valor(row.iloc[col_map['piso']]) if 'piso' in col_map else '',
-                'depto': limpiar_valor(row.iloc[col_map['depto']]) if 'depto' in col_map else ''
-            }
-
-            # Asegurar moneda válida
-            if not datos['moneda']:
-                datos['moneda'] = 'MXN'
-
-            # Asegurar tipo de cambio válido
-            if datos['tipo_cambio'] == 0:
-                datos['tipo_cambio'] = 1
-
-            # Insertar partida
-            cursor.execute("""
-                INSERT INTO partidas (
-                    proyecto_id, categoria, concepto, detalle, proveedor, unidad,
-                    cantidad, moneda, unitario, importe_sin_iva, sobrecosto_pct,
-                    sobrecosto_monto, iva_pct, iva_monto, importe_total, tipo_cambio,
-                    total_mxn, notas, es_parametro, torre, piso, depto
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                proyecto_id,
-                datos['categoria'],
-                datos['concepto'] or '',
-                datos['detalle'] or '',
-                datos['proveedor'] or '',
-                datos['unidad'] or '',
-                datos['cantidad'],
-                datos['moneda'],
-                datos['unitario'],
-                datos['importe_sin_iva'],
-                datos['sobrecosto_pct'],
-                datos['sobrecosto_monto'],
-                datos['iva_pct'],
-                datos['iva_monto'],
-                datos['importe_total'],
-                datos['tipo_cambio'],
-                datos['total_mxn'],
-                datos['notas'] or '',
-                datos['es_parametro'] or 'PRESUPUESTO',
-                datos['torre'] or '',
-                datos['piso'] or '',
-                datos['depto'] or ''
-            ))
-
-            partidas_importadas += 1
-
-        except Exception as e:
-            partidas_error += 1
-            if partidas_error <= 5:  # Solo mostrar primeros 5 errores
-                print(f"  Error en fila {idx + 1}: {e}")
-
-    conn.commit()
-    conn.close()
+            cursor.executemany(SQL_INSERTAR_PARTIDA, [fila for _, fila in filas])
+            partidas_importadas += len(filas)
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO lote")
+            for idx, fila in filas:
+                try:
+                    cursor.execute(SQL_INSERTAR_PARTIDA, fila)
+                    partidas_importadas += 1
+                except sqlite3.Error as e:
+                    registrar_error(idx, e)
+        cursor.execute("RELEASE lote")
+
+    # Cargar primero las filas en una tabla temporal (en memoria): leer y limpiar
+    # el Excel no retiene el bloqueo de escritura de la base
+    cursor.execute("DROP TABLE IF EXISTS temp.partidas_carga")
+    cursor.execute(SQL_CREAR_CARGA)
+    # BEGIN diferido: sólo escribe en la base temporal, no bloquea database.db
+    cursor.execute("BEGIN")
+    with conn:
+        # Cada bloque de filas se limpia y se arma por columnas con pandas; Python ya
+        # no recorre las filas: executemany recibe directamente las tuplas
+        inicio = header_row + 1
+        while bloque := list(islice(filas, TAMANO_LOTE)):
+            # dtype=object: sin inferencia de tipos, así un depto 102 queda '102' y no
+            # '102.0' según lo que traigan las demás filas del bloque
+            datos_excel = limpiar_bloque(pd.DataFrame(
+                bloque, index=range(inicio, inicio + len(bloque)), dtype=object
+            ).reindex(columns=range(len(headers))), col_map)
+            inicio += len(bloque)
+
+            insertar_lote(filas_partidas(datos_excel, col_map, proyecto_id))
+
+    # Reemplazar las partidas en una sola transacción de escritura: el DELETE y el
+    # INSERT ... SELECT se confirman juntos (una sola sincronización a disco) y si
+    # algo falla el proyecto conserva sus partidas anteriores
+    with transaccion():
+        cursor.execute("DELETE FROM partidas WHERE proyecto_id = ?", (proyecto_id,))
+        cursor.execute(SQL_PASAR_CARGA)
+    cursor.execute("DROP TABLE temp.partidas_carga")
+
+    # Estadísticas al día para que el planificador elija los índices compuestos
+    cursor.execute("ANALYZE partidas")
 
     print(f"\nResultado:")
     print(f"  - Partidas importadas: {partidas_importadas}")
@@ -244,16 +283,28 @@ def importar_todos():
         print(f"ERROR: No se encuentra la carpeta {EXCEL_FOLDER}")
         return
 
-    # Importar cada archivo
-    archivos_procesados = 0
+    pendientes = []
     for archivo, nombre_proyecto in ARCHIVOS_PROYECTOS.items():
         archivo_path = EXCEL_FOLDER / archivo
         if archivo_path.exists():
-            if importar_excel(archivo_path, nombre_proyecto):
-                archivos_procesados += 1
+            pendientes.append((archivo_path, nombre_proyecto))
         else:
             print(f"\nAdvertencia: No se encontró {archivo}")
 
+    # Importar cada archivo en su propio proceso: la lectura del Excel ocupa CPU y
+    # así se reparte entre núcleos. Cada proceso abre su conexión (spawn: no se
+    # hereda la de este proceso) y sólo toma el bloqueo de escritura al final
+    # para reemplazar las partidas de su proyecto; busy_timeout ordena los turnos
+    archivos_procesados = 0
+    if pendientes:
+        with ProcessPoolExecutor(
+            max_workers=min(len(pendientes), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=usar_base_datos,
+            initargs=(models.DATABASE_PATH,)
+        ) as executor:
+            archivos_procesados = sum(executor.map(importar_excel, *zip(*pendientes)))
+
     # Resumen final
     print("\n" + "="*60)
     print("RESUMEN DE IMPORTACIÓN")
@@ -266,19 +317,18 @@ def importar_todos():
     for p in proyectos:
         print(f"  - {p['nombre']} (ID: {p['id']})")
 
-    # Mostrar totales por proyecto
-    conn = get_connection()
-    cursor = conn.cursor()
+    # Mostrar totales por proyecto (una sola consulta; filas como tuplas simples)
+    cursor = get_connection().cursor()
+    cursor.row_factory = None
+    cursor.execute("""
+        SELECT proyecto_id, COUNT(*), SUM(total_mxn)
+        FROM partidas GROUP BY proyecto_id
+    """)
+    totales = {proyecto_id: (partidas, total) for proyecto_id, partidas, total in cursor}
     print(f"\nTotales por proyecto:")
     for p in proyectos:
-        cursor.execute("""
-            SELECT COUNT(*) as partidas, SUM(total_mxn) as total
-            FROM partidas WHERE proyecto_id = ?
-        """, (p['id'],))
-        row = cursor.fetchone()
-        total = row['total'] or 0
-        print(f"  - {p['nombre']}: {row['partidas']} partidas, ${total:,.2f} MXN")
-    conn.close()
+        partidas, total = totales.get(p['id'], (0, None))
+        print(f"  - {p['nombre']}: {partidas} partidas, ${total or 0:,.2f} MXN")
 
 if __name__ == "__main__":
     importar_todos()
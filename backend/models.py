@@ -2,21 +2,176 @@
 Modelos de base de datos SQLite para Presupuestos NAUKA
 """
 import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
 from pathlib import Path
 
+import orjson
+
 DATABASE_PATH = Path(__file__).parent / "database.db"
 
+# Pragmas aplicados una sola vez al abrir cada conexión
+PRAGMAS_CONEXION = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=5000;
+"""
+
+# Suficiente para todas las variantes de consultas de models (filtros opcionales incluidos)
+TAMANO_CACHE_SENTENCIAS = 256
+
+_local = threading.local()
+
+def usar_base_datos(ruta):
+    """Apuntar este proceso a otro archivo de base de datos (p.ej. en procesos de trabajo)"""
+    global DATABASE_PATH
+    DATABASE_PATH = ruta
+
 def get_connection():
-    """Obtener conexión a la base de datos"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """Obtener la conexión persistente del hilo actual (se abre en el primer uso)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        # sqlite3 guarda las sentencias preparadas por texto SQL; al ser una conexión
+        # persistente, las consultas frecuentes no se vuelven a compilar en cada petición.
+        # isolation_level=None: autocommit, sin el BEGIN implícito de sqlite3 antes de
+        # cada escritura; las transacciones se abren explícitamente con transaccion()
+        conn = sqlite3.connect(
+            DATABASE_PATH, isolation_level=None, cached_statements=TAMANO_CACHE_SENTENCIAS
+        )
+        conn.row_factory = sqlite3.Row
+        conn.executescript(PRAGMAS_CONEXION)
+        _local.conn = conn
     return conn
 
+def liberar_conexion():
+    """Descartar cualquier transacción que haya quedado abierta en la conexión del hilo"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+@contextmanager
+def transaccion():
+    """
+    Transacción de escritura en la conexión del hilo: BEGIN IMMEDIATE al entrar,
+    COMMIT al salir y ROLLBACK si hay una excepción. Dentro de otra transacción se
+    une a ella.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    with conn:
+        yield conn
+
+def cerrar_conexion():
+    """Cerrar la conexión del hilo actual"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
 def init_database():
     """Inicializar la base de datos con las tablas necesarias"""
     conn = get_connection()
     cursor = conn.cursor()
 
+    # Todo el esquema en una sola transacción: sqlite3 confirma cada DDL por
+    # separado si no hay una abierta (una sincronización a disco por sentencia)
+    with transaccion():
+        _migrar_esquema(cursor)
+        _crear_esquema(cursor)
+
+    # Estadísticas para que el planificador elija entre los índices compuestos.
+    # ANALYZE completo sólo la primera vez: con varios workers cada uno pasa por
+    # aquí al arrancar, y PRAGMA optimize sólo reanaliza lo que haga falta
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    cursor.execute("PRAGMA optimize" if cursor.fetchone() else "ANALYZE")
+    print("Base de datos inicializada correctamente")
+
+# Categorías de cada cotización, una fila por categoría, para filtrar por índice en
+# lugar de guardarlas como JSON en cotizaciones. La usan tanto el esquema como la
+# migración que la llena
+SQL_TABLA_COTIZACION_CATEGORIAS = """
+    CREATE TABLE IF NOT EXISTS cotizacion_categorias (
+        cotizacion_id INTEGER NOT NULL,
+        categoria TEXT NOT NULL COLLATE NOCASE,
+        PRIMARY KEY (cotizacion_id, categoria),
+        FOREIGN KEY (cotizacion_id) REFERENCES cotizaciones(id) ON DELETE CASCADE
+    )
+"""
+
+# Cambios sobre bases ya existentes, en orden de aparición, como (tabla, sql). PRAGMA
+# user_version guarda cuántos se aplicaron; las bases nuevas ya nacen con el esquema
+# final. Para una nueva columna: agregarla al CREATE TABLE y al final de aquí
+MIGRACIONES = (
+    ('partidas', "ALTER TABLE partidas ADD COLUMN torre TEXT"),
+    ('partidas', "ALTER TABLE partidas ADD COLUMN piso TEXT"),
+    ('partidas', "ALTER TABLE partidas ADD COLUMN depto TEXT"),
+    ('proyectos', "ALTER TABLE proyectos ADD COLUMN version_partidas INTEGER NOT NULL DEFAULT 0"),
+    ('cotizaciones', "ALTER TABLE cotizaciones ADD COLUMN archivo_hash TEXT"),
+    # Índices de partidas que ya cubren los compuestos por (proyecto_id, ...): todas
+    # las consultas filtran primero por proyecto, y cada índice de más es un árbol
+    # que actualizar en cada alta
+    ('partidas', "DROP INDEX IF EXISTS idx_partidas_categoria"),
+    ('partidas', "DROP INDEX IF EXISTS idx_partidas_concepto"),
+    ('partidas', "DROP INDEX IF EXISTS idx_partidas_proyecto"),
+    ('partidas', "DROP INDEX IF EXISTS idx_partidas_proy_torre"),
+    ('cotizaciones', SQL_TABLA_COTIZACION_CATEGORIAS),
+    ('cotizaciones', """
+        INSERT OR IGNORE INTO cotizacion_categorias (cotizacion_id, categoria)
+        SELECT c.id, j.value FROM cotizaciones c, json_each(c.categorias) j
+        WHERE json_valid(c.categorias) AND j.type = 'text' AND j.value != ''
+    """),
+    # Ya copiadas a cotizacion_categorias
+    ('cotizaciones', "ALTER TABLE cotizaciones DROP COLUMN categorias"),
+    # Un mismo archivo sólo se registra una vez por proyecto y proveedor (índice único
+    # en el esquema). Si ya había repetidos, conserva el hash la cotización más nueva,
+    # que es la que devolvía buscar_cotizacion_por_hash
+    ('cotizaciones', """
+        UPDATE cotizaciones SET archivo_hash = NULL
+        WHERE archivo_hash IS NOT NULL AND id NOT IN (
+            SELECT MAX(id) FROM cotizaciones WHERE archivo_hash IS NOT NULL
+            GROUP BY proyecto_id, proveedor, archivo_hash
+        )
+    """),
+    ('cotizaciones', "DROP INDEX IF EXISTS idx_cot_archivo_hash"),
+)
+
+def _migrar_esquema(cursor):
+    """
+    Aplicar las migraciones pendientes según PRAGMA user_version. Cualquier error
+    aborta la transacción de init_database y la migración se reintenta al arrancar
+    otra vez; sólo se ignora una columna que ya existía
+    """
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    if version >= len(MIGRACIONES):
+        return
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tablas = {row[0] for row in cursor.fetchall()}
+
+    for tabla, sql in MIGRACIONES[version:]:
+        if tabla not in tablas:
+            # _crear_esquema la crea después ya con el esquema final
+            continue
+        try:
+            cursor.execute(sql)
+        except sqlite3.OperationalError as e:
+            # Bases anteriores a user_version que ya tenían la columna
+            if 'ADD COLUMN' not in sql or 'duplicate column name' not in str(e):
+                raise
+
+    cursor.execute(f"PRAGMA user_version = {len(MIGRACIONES)}")
+
+def _crear_esquema(cursor):
+    """Crear tablas, índices y triggers que falten (todas las sentencias son idempotentes)"""
     # Tabla de Proyectos
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS proyectos (
@@ -24,7 +179,8 @@ def init_database():
             nombre TEXT NOT NULL UNIQUE,
             descripcion TEXT,
             fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            fecha_modificacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            fecha_modificacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version_partidas INTEGER NOT NULL DEFAULT 0
         )
     """)
 
@@ -60,20 +216,6 @@ def init_database():
         )
     """)
 
-    # Agregar columnas torre, piso, depto si no existen (para bases de datos existentes)
-    try:
-        cursor.execute("ALTER TABLE partidas ADD COLUMN torre TEXT")
-    except:
-        pass
-    try:
-        cursor.execute("ALTER TABLE partidas ADD COLUMN piso TEXT")
-    except:
-        pass
-    try:
-        cursor.execute("ALTER TABLE partidas ADD COLUMN depto TEXT")
-    except:
-        pass
-
     # Tabla de Glosario - Categorías
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS categorias (
@@ -109,10 +251,62 @@ def init_database():
         ('EUR', 22)
     """)
 
-    # Crear índices para mejorar rendimiento
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_proyecto ON partidas(proyecto_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_categoria ON partidas(categoria)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_concepto ON partidas(concepto)")
+    # Índices de partidas: todos empiezan por proyecto_id, que sirve también para
+    # las consultas y borrados por proyecto
+    # Listado de partidas: filtra por proyecto/categoría/concepto y ordena por detalle
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_partidas_proy_cat_conc
+        ON partidas(proyecto_id, categoria, concepto, detalle)
+    """)
+    # Resumen por categoría y totales del proyecto: se resuelven sólo con el índice
+    # (covering), sin leer las filas de la tabla
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_partidas_proy_cat_total
+        ON partidas(proyecto_id, categoria, total_mxn)
+    """)
+    # Filtros de ubicación del resumen jerárquico (torre, torre+piso, torre+piso+depto)
+    # y sus listas de valores
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_partidas_proy_ubic
+        ON partidas(proyecto_id, torre, piso, depto)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_proy_piso ON partidas(proyecto_id, piso)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_proy_depto ON partidas(proyecto_id, depto)")
+    # Valores únicos por proyecto (proveedores, conceptos sin categoría): se leen en
+    # orden directamente del índice, sin ordenar ni eliminar duplicados aparte
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_proy_proveedor ON partidas(proyecto_id, proveedor)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_partidas_proy_concepto ON partidas(proyecto_id, concepto)")
+
+    # Versión de las partidas de cada proyecto: la incrementan los triggers en cada
+    # alta, cambio o baja, y la API la usa como ETag de los resúmenes
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_partidas_version_insert AFTER INSERT ON partidas
+        BEGIN
+            UPDATE proyectos SET version_partidas = version_partidas + 1 WHERE id = NEW.proyecto_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_partidas_version_update AFTER UPDATE ON partidas
+        BEGIN
+            UPDATE proyectos SET version_partidas = version_partidas + 1
+            WHERE id IN (OLD.proyecto_id, NEW.proyecto_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_partidas_version_delete AFTER DELETE ON partidas
+        BEGIN
+            UPDATE proyectos SET version_partidas = version_partidas + 1 WHERE id = OLD.proyecto_id;
+        END
+    """)
+    # Fecha de modificación de las partidas para cualquier UPDATE que no la fije
+    # explícitamente (cambios masivos, SQL directo)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_partidas_fecha_modificacion AFTER UPDATE ON partidas
+        WHEN NEW.fecha_modificacion IS OLD.fecha_modificacion
+        BEGIN
+            UPDATE partidas SET fecha_modificacion = CURRENT_TIMESTAMP WHERE id = NEW.id;
+        END
+    """)
 
     # Tabla de Glosario - Categorías por proyecto
     cursor.execute("""
@@ -146,7 +340,6 @@ def init_database():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             proyecto_id INTEGER NOT NULL,
             proveedor TEXT NOT NULL,
-            categorias TEXT,
             archivo_nombre TEXT,
             fecha_cotizacion DATE,
             fecha_carga TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -154,6 +347,8 @@ def init_database():
             total REAL DEFAULT 0,
             moneda TEXT DEFAULT 'MXN',
             notas TEXT,
+            -- Hash SHA-256 del archivo subido, para reconocer subidas repetidas
+            archivo_hash TEXT,
             FOREIGN KEY (proyecto_id) REFERENCES proyectos(id) ON DELETE CASCADE
         )
     """)
@@ -177,12 +372,52 @@ def init_database():
     # Índices para cotizaciones
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_cot_proveedor ON cotizaciones(proveedor)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_cot_proyecto ON cotizaciones(proyecto_id)")
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_cot_archivo_unico
+        ON cotizaciones(proyecto_id, proveedor, archivo_hash)
+    """)
+    cursor.execute(SQL_TABLA_COTIZACION_CATEGORIAS)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cot_categorias_categoria ON cotizacion_categorias(categoria)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_cotizacion ON cotizacion_items(cotizacion_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_descripcion ON cotizacion_items(descripcion)")
 
-    conn.commit()
-    conn.close()
-    print("Base de datos inicializada correctamente")
+    # num_items y total de cada cotización se ajustan con cada cambio de sus items,
+    # sin volver a recorrer la tabla
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_insert AFTER INSERT ON cotizacion_items
+        BEGIN
+            UPDATE cotizaciones SET num_items = num_items + 1, total = total + COALESCE(NEW.importe, 0)
+            WHERE id = NEW.cotizacion_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_update AFTER UPDATE OF importe, cotizacion_id ON cotizacion_items
+        BEGIN
+            UPDATE cotizaciones SET num_items = num_items - 1, total = total - COALESCE(OLD.importe, 0)
+            WHERE id = OLD.cotizacion_id;
+            UPDATE cotizaciones SET num_items = num_items + 1, total = total + COALESCE(NEW.importe, 0)
+            WHERE id = NEW.cotizacion_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_delete AFTER DELETE ON cotizacion_items
+        BEGIN
+            UPDATE cotizaciones SET num_items = num_items - 1, total = total - COALESCE(OLD.importe, 0)
+            WHERE id = OLD.cotizacion_id;
+        END
+    """)
+
+    # Tabla de trabajos en segundo plano (importaciones largas)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'en_proceso',
+            resultado TEXT,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_modificacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
 
 # Funciones CRUD para Proyectos
 def crear_proyecto(nombre, descripcion=""):
@@ -193,22 +428,18 @@ def crear_proyecto(nombre, descripcion=""):
             "INSERT INTO proyectos (nombre, descripcion) VALUES (?, ?)",
             (nombre, descripcion)
         )
-        conn.commit()
         return cursor.lastrowid
     except sqlite3.IntegrityError:
         # Si ya existe, obtener su ID
         cursor.execute("SELECT id FROM proyectos WHERE nombre = ?", (nombre,))
         row = cursor.fetchone()
         return row['id'] if row else None
-    finally:
-        conn.close()
 
 def obtener_proyectos():
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM proyectos ORDER BY nombre")
     proyectos = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return proyectos
 
 def obtener_proyecto(proyecto_id):
@@ -216,46 +447,78 @@ def obtener_proyecto(proyecto_id):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM proyectos WHERE id = ?", (proyecto_id,))
     row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
+def obtener_version_partidas(proyecto_id):
+    """Contador que cambia cada vez que se modifican las partidas del proyecto"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT version_partidas FROM proyectos WHERE id = ?", (proyecto_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
 def eliminar_proyecto(proyecto_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM proyectos WHERE id = ?", (proyecto_id,))
-    conn.commit()
-    conn.close()
 
 # Funciones CRUD para Partidas
-def crear_partida(proyecto_id, datos):
-    conn = get_connection()
-    cursor = conn.cursor()
+INSERT_PARTIDA_SQL = """
+    INSERT INTO partidas (
+        proyecto_id, categoria, concepto, detalle, proveedor, unidad,
+        cantidad, moneda, unitario, importe_sin_iva, sobrecosto_pct,
+        sobrecosto_monto, iva_pct, iva_monto, importe_total, tipo_cambio,
+        total_mxn, notas, es_parametro, torre, piso, depto
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
-    # Calcular campos automáticos
-    cantidad = float(datos.get('cantidad', 0) or 0)
-    unitario = float(datos.get('unitario', 0) or 0)
+# Campos que actualiza ACTUALIZAR_PARTIDA_SQL: los de INSERT_PARTIDA_SQL y en el
+# mismo orden, sin proyecto_id
+CAMPOS_ACTUALIZABLES = (
+    'categoria', 'concepto', 'detalle', 'proveedor', 'unidad', 'cantidad', 'moneda',
+    'unitario', 'importe_sin_iva', 'sobrecosto_pct', 'sobrecosto_monto', 'iva_pct',
+    'iva_monto', 'importe_total', 'tipo_cambio', 'total_mxn', 'notas', 'es_parametro',
+    'torre', 'piso', 'depto'
+)
+
+# ?1..?21 son los valores (se usan en el SET y en la comparación) y el último es el
+# id. Si ningún campo cambia, la fila no se toca: ni fecha, ni versión del proyecto.
+# La fecha se fija aquí y no se deja al trigger porque RETURNING devuelve la fila
+# antes de los triggers AFTER
+ACTUALIZAR_PARTIDA_SQL = f"""
+    UPDATE partidas SET
+        {', '.join(f'{campo} = ?{n}' for n, campo in enumerate(CAMPOS_ACTUALIZABLES, 1))},
+        fecha_modificacion = CURRENT_TIMESTAMP
+    WHERE id = ?{len(CAMPOS_ACTUALIZABLES) + 1}
+    AND ({', '.join(CAMPOS_ACTUALIZABLES)})
+        IS NOT ({', '.join(f'?{n}' for n in range(1, len(CAMPOS_ACTUALIZABLES) + 1))})
+"""
+
+def _num(valor, defecto=0.0):
+    """float(valor or defecto), sin convertir cuando ya es un float distinto de cero"""
+    if type(valor) is float and valor:
+        return valor
+    return float(valor) if valor else defecto
+
+def _valores_partida(proyecto_id, datos):
+    """Calcular campos automáticos y devolver la tupla de valores para INSERT_PARTIDA_SQL"""
+    cantidad = _num(datos.get('cantidad'))
+    unitario = _num(datos.get('unitario'))
     importe_sin_iva = cantidad * unitario
 
-    sobrecosto_pct = float(datos.get('sobrecosto_pct', 0) or 0)
+    sobrecosto_pct = _num(datos.get('sobrecosto_pct'))
     sobrecosto_monto = importe_sin_iva * sobrecosto_pct
 
-    iva_pct = float(datos.get('iva_pct', 0) or 0)
+    iva_pct = _num(datos.get('iva_pct'))
     base_con_sobrecosto = importe_sin_iva + sobrecosto_monto
     iva_monto = base_con_sobrecosto * iva_pct
 
     importe_total = base_con_sobrecosto + iva_monto
 
-    tipo_cambio = float(datos.get('tipo_cambio', 1) or 1)
+    tipo_cambio = _num(datos.get('tipo_cambio'), 1.0)
     total_mxn = importe_total * tipo_cambio
 
-    cursor.execute("""
-        INSERT INTO partidas (
-            proyecto_id, categoria, concepto, detalle, proveedor, unidad,
-            cantidad, moneda, unitario, importe_sin_iva, sobrecosto_pct,
-            sobrecosto_monto, iva_pct, iva_monto, importe_total, tipo_cambio,
-            total_mxn, notas, es_parametro, torre, piso, depto
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    return (
         proyecto_id,
         datos.get('categoria', ''),
         datos.get('concepto', ''),
@@ -278,14 +541,38 @@ def crear_partida(proyecto_id, datos):
         datos.get('torre', ''),
         datos.get('piso', ''),
         datos.get('depto', '')
-    ))
+    )
 
-    conn.commit()
-    partida_id = cursor.lastrowid
-    conn.close()
-    return partida_id
+def crear_partida(proyecto_id, datos):
+    """Crear una partida y devolver la fila insertada"""
+    conn = get_connection()
+    cursor = conn.cursor()
 
-def obtener_partidas(proyecto_id, categoria=None, concepto=None):
+    # RETURNING devuelve la fila creada sin una segunda consulta
+    cursor.execute(INSERT_PARTIDA_SQL + " RETURNING *", _valores_partida(proyecto_id, datos))
+    partida = dict(cursor.fetchone())
+    return partida
+
+def crear_partidas_bulk(proyecto_id, lista_datos):
+    """Crear varias partidas en una sola transacción y devolver sus ids"""
+    if not lista_datos:
+        return []
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    filas = [_valores_partida(proyecto_id, datos) for datos in lista_datos]
+    with transaccion():
+        cursor.executemany(INSERT_PARTIDA_SQL, filas)
+
+        # Dentro de una misma transacción los ids AUTOINCREMENT son consecutivos
+        cursor.execute("SELECT last_insert_rowid()")
+        ultimo_id = cursor.fetchone()[0]
+
+    return list(range(ultimo_id - len(filas) + 1, ultimo_id + 1))
+
+def iter_partidas(proyecto_id, categoria=None, concepto=None):
+    """Iterar las partidas de un proyecto fila por fila, sin cargarlas todas en memoria"""
     conn = get_connection()
     cursor = conn.cursor()
 
@@ -302,117 +589,99 @@ def obtener_partidas(proyecto_id, categoria=None, concepto=None):
 
     query += " ORDER BY categoria, concepto, detalle"
 
+    # Tuplas simples en lugar de sqlite3.Row: los nombres se leen una sola vez
+    cursor.row_factory = None
     cursor.execute(query, params)
-    partidas = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return partidas
+    columnas = [d[0] for d in cursor.description]
+    for row in cursor:
+        yield dict(zip(columnas, row))
+
+def obtener_partidas(proyecto_id, categoria=None, concepto=None):
+    return list(iter_partidas(proyecto_id, categoria, concepto))
 
 def obtener_partida(partida_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM partidas WHERE id = ?", (partida_id,))
     row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 def actualizar_partida(partida_id, datos):
+    """Actualizar una partida y devolver la fila actualizada (None si no existe)"""
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Calcular campos automáticos
-    cantidad = float(datos.get('cantidad', 0) or 0)
-    unitario = float(datos.get('unitario', 0) or 0)
-    importe_sin_iva = cantidad * unitario
-
-    sobrecosto_pct = float(datos.get('sobrecosto_pct', 0) or 0)
-    sobrecosto_monto = importe_sin_iva * sobrecosto_pct
-
-    iva_pct = float(datos.get('iva_pct', 0) or 0)
-    base_con_sobrecosto = importe_sin_iva + sobrecosto_monto
-    iva_monto = base_con_sobrecosto * iva_pct
+    # Mismos campos y cálculos que el alta (sin proyecto_id, que no cambia)
+    cursor.execute(ACTUALIZAR_PARTIDA_SQL + " RETURNING *", (*_valores_partida(None, datos)[1:], partida_id))
 
-    importe_total = base_con_sobrecosto + iva_monto
+    row = cursor.fetchone()
+    if row is None:
+        # Sin cambios (o no existe): se devuelve la fila tal como está
+        return obtener_partida(partida_id)
+    return dict(row)
 
-    tipo_cambio = float(datos.get('tipo_cambio', 1) or 1)
-    total_mxn = importe_total * tipo_cambio
+def actualizar_partidas_bulk(lista_datos):
+    """Actualizar varias partidas (cada una con su 'id') en una sola transacción y devolver cuántas cambiaron"""
+    filas = [(*_valores_partida(None, datos)[1:], datos['id']) for datos in lista_datos]
 
-    cursor.execute("""
-        UPDATE partidas SET
-            categoria = ?, concepto = ?, detalle = ?, proveedor = ?, unidad = ?,
-            cantidad = ?, moneda = ?, unitario = ?, importe_sin_iva = ?,
-            sobrecosto_pct = ?, sobrecosto_monto = ?, iva_pct = ?, iva_monto = ?,
-            importe_total = ?, tipo_cambio = ?, total_mxn = ?, notas = ?,
-            es_parametro = ?, torre = ?, piso = ?, depto = ?,
-            fecha_modificacion = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (
-        datos.get('categoria', ''),
-        datos.get('concepto', ''),
-        datos.get('detalle', ''),
-        datos.get('proveedor', ''),
-        datos.get('unidad', ''),
-        cantidad,
-        datos.get('moneda', 'MXN'),
-        unitario,
-        importe_sin_iva,
-        sobrecosto_pct,
-        sobrecosto_monto,
-        iva_pct,
-        iva_monto,
-        importe_total,
-        tipo_cambio,
-        total_mxn,
-        datos.get('notas', ''),
-        datos.get('es_parametro', 'PRESUPUESTO'),
-        datos.get('torre', ''),
-        datos.get('piso', ''),
-        datos.get('depto', ''),
-        partida_id
-    ))
+    conn = get_connection()
+    cursor = conn.cursor()
 
-    conn.commit()
-    conn.close()
+    with transaccion():
+        cursor.executemany(ACTUALIZAR_PARTIDA_SQL, filas)
+    return max(cursor.rowcount, 0)
 
 def eliminar_partida(partida_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM partidas WHERE id = ?", (partida_id,))
-    conn.commit()
-    conn.close()
 
-# Funciones para obtener categorías y conceptos únicos
-def obtener_categorias_proyecto(proyecto_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT DISTINCT categoria FROM partidas
-        WHERE proyecto_id = ? AND categoria IS NOT NULL AND categoria != ''
-        ORDER BY categoria
-    """, (proyecto_id,))
-    categorias = [row['categoria'] for row in cursor.fetchall()]
-    conn.close()
-    return categorias
+# Listas de ids como un solo parámetro (arreglo JSON): el texto SQL no depende de
+# cuántos ids haya, así que la sentencia preparada se reutiliza desde la cache de la
+# conexión y no hay límite de parámetros
+SQL_IDS_JSON = "SELECT value FROM json_each(?)"
 
-def obtener_conceptos_proyecto(proyecto_id, categoria=None):
+def _ids_json(ids):
+    """Arreglo JSON con los ids, para SQL_IDS_JSON"""
+    return orjson.dumps(list(ids)).decode()
+
+def eliminar_partidas(ids):
+    """Eliminar varias partidas en una sola sentencia y devolver cuántas se borraron"""
     conn = get_connection()
     cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM partidas WHERE id IN ({SQL_IDS_JSON})", (_ids_json(ids),))
+    return cursor.rowcount
 
-    if categoria:
-        cursor.execute("""
-            SELECT DISTINCT concepto FROM partidas
-            WHERE proyecto_id = ? AND categoria = ? AND concepto IS NOT NULL AND concepto != ''
-            ORDER BY concepto
-        """, (proyecto_id, categoria))
-    else:
-        cursor.execute("""
-            SELECT DISTINCT concepto FROM partidas
-            WHERE proyecto_id = ? AND concepto IS NOT NULL AND concepto != ''
-            ORDER BY concepto
-        """, (proyecto_id,))
+# Funciones para obtener categorías y conceptos únicos
+# Texto SQL fijo por campo: cada llamada reutiliza la sentencia ya preparada
+# en la cache de la conexión (cached_statements) en lugar de volver a compilarla
+SQL_VALORES_DISTINTOS = {
+    campo: f"""
+        SELECT DISTINCT {campo} FROM partidas
+        WHERE proyecto_id = ? AND {campo} IS NOT NULL AND {campo} != ''
+        ORDER BY {campo}
+    """
+    for campo in ('categoria', 'torre', 'piso', 'proveedor', 'depto')
+}
+
+def _valores_distintos(proyecto_id, campo):
+    """Valores únicos no vacíos de un campo de partidas del proyecto, ordenados"""
+    cursor = get_connection().execute(SQL_VALORES_DISTINTOS[campo], (proyecto_id,))
+    return [row[0] for row in cursor.fetchall()]
 
-    conceptos = [row['concepto'] for row in cursor.fetchall()]
-    conn.close()
-    return conceptos
+def obtener_categorias_proyecto(proyecto_id):
+    return _valores_distintos(proyecto_id, 'categoria')
+
+def obtener_conceptos_proyecto(proyecto_id, categoria=None):
+    """Conceptos únicos del proyecto, opcionalmente de una sola categoría"""
+    # Una sola sentencia para ambos casos: ?2 NULL desactiva el filtro de categoría
+    cursor = get_connection().execute("""
+        SELECT DISTINCT concepto FROM partidas
+        WHERE proyecto_id = ?1 AND (?2 IS NULL OR categoria = ?2)
+          AND concepto IS NOT NULL AND concepto != ''
+        ORDER BY concepto
+    """, (proyecto_id, categoria or None))
+    return [row[0] for row in cursor.fetchall()]
 
 # Funciones para resumen/totales
 def obtener_resumen_proyecto(proyecto_id):
@@ -432,22 +701,12 @@ def obtener_resumen_proyecto(proyecto_id):
 
     resumen_categorias = [dict(row) for row in cursor.fetchall()]
 
-    cursor.execute("""
-        SELECT
-            SUM(total_mxn) as total_proyecto,
-            COUNT(*) as total_partidas
-        FROM partidas
-        WHERE proyecto_id = ?
-    """, (proyecto_id,))
-
-    totales = dict(cursor.fetchone())
-
-    conn.close()
-
+    # Los totales del proyecto se suman sobre las categorías ya agrupadas,
+    # sin una segunda pasada sobre partidas
     return {
         'categorias': resumen_categorias,
-        'total_proyecto': totales['total_proyecto'] or 0,
-        'total_partidas': totales['total_partidas'] or 0
+        'total_proyecto': sum(fila['total_categoria'] or 0 for fila in resumen_categorias),
+        'total_partidas': sum(fila['num_partidas'] for fila in resumen_categorias)
     }
 
 # Tipos de cambio
@@ -456,20 +715,46 @@ def obtener_tipos_cambio():
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM tipos_cambio ORDER BY moneda")
     tipos = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return tipos
 
 def actualizar_tipo_cambio(moneda, valor):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO tipos_cambio (moneda, valor) VALUES (?, ?)",
-        (moneda, valor)
-    )
-    conn.commit()
-    conn.close()
+    # Upsert en el lugar: INSERT OR REPLACE borraba la fila y la volvía a insertar
+    cursor.execute("""
+        INSERT INTO tipos_cambio (moneda, valor) VALUES (?, ?)
+        ON CONFLICT(moneda) DO UPDATE SET valor = excluded.valor
+    """, (moneda, valor))
 
 # Funciones para resumen agrupado
+# Campos válidos para agrupar en obtener_resumen_agrupado (se interpolan en el SQL)
+CAMPOS_AGRUPABLES = frozenset({
+    'categoria', 'concepto', 'proveedor', 'torre', 'piso', 'depto', 'moneda', 'es_parametro'
+})
+
+@lru_cache(maxsize=256)
+def _sql_resumen_agrupado(campos_filtrados):
+    """Consulta del resumen agrupado por una tupla de campos (se arma una vez por combinación)"""
+    campos = ', '.join(campos_filtrados)
+
+    # Los totales del proyecto salen de la misma agregación (funciones de ventana
+    # sobre los grupos) en lugar de una segunda pasada sobre partidas
+    return f"""
+        SELECT
+            {campos},
+            COUNT(*) as num_partidas,
+            SUM(total_mxn) as total_mxn,
+            SUM(importe_sin_iva) as subtotal,
+            SUM(iva_monto) as total_iva,
+            SUM(sobrecosto_monto) as total_sobrecosto,
+            SUM(SUM(total_mxn)) OVER () as total_proyecto,
+            SUM(COUNT(*)) OVER () as total_partidas
+        FROM partidas
+        WHERE proyecto_id = ?
+        GROUP BY {campos}
+        ORDER BY total_mxn DESC
+    """
+
 def obtener_resumen_agrupado(proyecto_id, agrupar_por):
     """
     Obtener resumen agrupado por los campos especificados.
@@ -478,256 +763,150 @@ def obtener_resumen_agrupado(proyecto_id, agrupar_por):
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Campos validos para agrupar
-    campos_validos = ['categoria', 'concepto', 'proveedor', 'torre', 'piso', 'depto', 'moneda', 'es_parametro']
-    campos_filtrados = [c for c in agrupar_por if c in campos_validos]
+    # Sólo campos de la lista blanca, sin repetidos y en el orden pedido
+    campos_filtrados = list(dict.fromkeys(c for c in agrupar_por if c in CAMPOS_AGRUPABLES))
 
     if not campos_filtrados:
         campos_filtrados = ['categoria']
 
-    # Construir la consulta SQL dinamicamente
-    campos_select = ', '.join(campos_filtrados)
-    campos_group = ', '.join(campos_filtrados)
-
-    query = f"""
-        SELECT
-            {campos_select},
-            COUNT(*) as num_partidas,
-            SUM(total_mxn) as total_mxn,
-            SUM(importe_sin_iva) as subtotal,
-            SUM(iva_monto) as total_iva,
-            SUM(sobrecosto_monto) as total_sobrecosto
-        FROM partidas
-        WHERE proyecto_id = ?
-        GROUP BY {campos_group}
-        ORDER BY total_mxn DESC
-    """
-
-    cursor.execute(query, (proyecto_id,))
+    cursor.execute(_sql_resumen_agrupado(tuple(campos_filtrados)), (proyecto_id,))
     resultados = [dict(row) for row in cursor.fetchall()]
 
-    # Obtener totales generales
-    cursor.execute("""
-        SELECT
-            SUM(total_mxn) as total_proyecto,
-            COUNT(*) as total_partidas
-        FROM partidas
-        WHERE proyecto_id = ?
-    """, (proyecto_id,))
-    totales = dict(cursor.fetchone())
-
-    conn.close()
+    total_proyecto = total_partidas = 0
+    for fila in resultados:
+        total_proyecto = fila.pop('total_proyecto')
+        total_partidas = fila.pop('total_partidas')
 
     return {
         'agrupado_por': campos_filtrados,
         'resultados': resultados,
-        'total_proyecto': totales['total_proyecto'] or 0,
-        'total_partidas': totales['total_partidas'] or 0
+        'total_proyecto': total_proyecto or 0,
+        'total_partidas': total_partidas or 0
     }
 
 # Funciones para obtener valores unicos de torre, piso, depto
 def obtener_torres_proyecto(proyecto_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT DISTINCT torre FROM partidas
-        WHERE proyecto_id = ? AND torre IS NOT NULL AND torre != ''
-        ORDER BY torre
-    """, (proyecto_id,))
-    torres = [row['torre'] for row in cursor.fetchall()]
-    conn.close()
-    return torres
+    return _valores_distintos(proyecto_id, 'torre')
 
 def obtener_pisos_proyecto(proyecto_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT DISTINCT piso FROM partidas
-        WHERE proyecto_id = ? AND piso IS NOT NULL AND piso != ''
-        ORDER BY piso
-    """, (proyecto_id,))
-    pisos = [row['piso'] for row in cursor.fetchall()]
-    conn.close()
-    return pisos
+    return _valores_distintos(proyecto_id, 'piso')
 
 def obtener_proveedores_proyecto(proyecto_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT DISTINCT proveedor FROM partidas
-        WHERE proyecto_id = ? AND proveedor IS NOT NULL AND proveedor != ''
-        ORDER BY proveedor
-    """, (proyecto_id,))
-    proveedores = [row['proveedor'] for row in cursor.fetchall()]
-    conn.close()
-    return proveedores
+    return _valores_distintos(proyecto_id, 'proveedor')
 
 # Funciones para resumen jerárquico
-def obtener_resumen_jerarquico_nivel1(proyecto_id, filtros=None):
-    """
-    Obtener nivel 1 del resumen jerárquico: Categorías con totales
-    filtros: dict con keys opcionales: torre, piso, depto
-    """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Construir query con filtros opcionales
-    query = """
-        SELECT
-            categoria,
-            COUNT(*) as num_partidas,
-            SUM(total_mxn) as total_mxn
+def _agregar_nivel(grupos, clave, total_mxn):
+    """Acumular una partida en el grupo 'clave' con la semántica de COUNT(*)/SUM() de SQL"""
+    grupo = grupos.get(clave)
+    if grupo is None:
+        grupo = grupos[clave] = {'num_partidas': 0, 'total_mxn': None}
+    grupo['num_partidas'] += 1
+    if total_mxn is not None:
+        grupo['total_mxn'] = (grupo['total_mxn'] or 0) + total_mxn
+
+def _ordenar_por_total(filas):
+    """ORDER BY total_mxn DESC (NULL al final)"""
+    filas.sort(key=lambda f: (f['total_mxn'] is not None, f['total_mxn'] or 0), reverse=True)
+    return filas
+
+FILTROS_UBICACION = ('torre', 'piso', 'depto')
+
+# Campos de cada detalle del nivel 3, en el orden en que los devuelve la consulta
+# después de categoria y concepto
+CAMPOS_DETALLE = (
+    'id', 'detalle', 'proveedor', 'torre', 'piso', 'depto', 'cantidad', 'unidad', 'total_mxn'
+)
+
+@lru_cache(maxsize=None)
+def _sql_resumen_jerarquico(campos):
+    """Consulta del resumen jerárquico para una combinación de filtros de ubicación (8 en total)"""
+    filtros = ''.join(f" AND {campo} = ?" for campo in campos)
+    return f"""
+        SELECT categoria, concepto, {', '.join(CAMPOS_DETALLE)}
         FROM partidas
-        WHERE proyecto_id = ?
-    """
-    params = [proyecto_id]
-
-    if filtros:
-        if filtros.get('torre'):
-            query += " AND torre = ?"
-            params.append(filtros['torre'])
-        if filtros.get('piso'):
-            query += " AND piso = ?"
-            params.append(filtros['piso'])
-        if filtros.get('depto'):
-            query += " AND depto = ?"
-            params.append(filtros['depto'])
-
-    query += """
-        GROUP BY categoria
+        WHERE proyecto_id = ?{filtros}
         ORDER BY total_mxn DESC
     """
 
-    cursor.execute(query, params)
-    categorias = [dict(row) for row in cursor.fetchall()]
-
-    # Obtener totales generales
-    query_totales = """
-        SELECT
-            COUNT(DISTINCT categoria) as num_categorias,
-            COUNT(*) as total_partidas,
-            SUM(total_mxn) as total_proyecto
-        FROM partidas
-        WHERE proyecto_id = ?
+def obtener_resumen_jerarquico(proyecto_id, filtros=None):
     """
-    params_totales = [proyecto_id]
-
-    if filtros:
-        if filtros.get('torre'):
-            query_totales += " AND torre = ?"
-            params_totales.append(filtros['torre'])
-        if filtros.get('piso'):
-            query_totales += " AND piso = ?"
-            params_totales.append(filtros['piso'])
-        if filtros.get('depto'):
-            query_totales += " AND depto = ?"
-            params_totales.append(filtros['depto'])
-
-    cursor.execute(query_totales, params_totales)
-    totales = dict(cursor.fetchone())
-
-    conn.close()
-
-    return {
-        'categorias': categorias,
-        'num_categorias': totales['num_categorias'] or 0,
-        'total_partidas': totales['total_partidas'] or 0,
-        'total_proyecto': totales['total_proyecto'] or 0
-    }
-
-def obtener_resumen_jerarquico_nivel2(proyecto_id, categoria, filtros=None):
-    """
-    Obtener nivel 2 del resumen jerárquico: Conceptos de una categoría
-    """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    query = """
-        SELECT
-            concepto,
-            COUNT(*) as num_partidas,
-            SUM(total_mxn) as total_mxn
-        FROM partidas
-        WHERE proyecto_id = ? AND categoria = ?
-    """
-    params = [proyecto_id, categoria]
-
-    if filtros:
-        if filtros.get('torre'):
-            query += " AND torre = ?"
-            params.append(filtros['torre'])
-        if filtros.get('piso'):
-            query += " AND piso = ?"
-            params.append(filtros['piso'])
-        if filtros.get('depto'):
-            query += " AND depto = ?"
-            params.append(filtros['depto'])
-
-    query += """
-        GROUP BY concepto
-        ORDER BY total_mxn DESC
-    """
-
-    cursor.execute(query, params)
-    conceptos = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-
-    return {'conceptos': conceptos}
-
-def obtener_resumen_jerarquico_nivel3(proyecto_id, categoria, concepto, filtros=None):
-    """
-    Obtener nivel 3 del resumen jerárquico: Detalles de un concepto
+    Obtener los tres niveles del resumen jerárquico con una sola consulta:
+    nivel1 (categorías), nivel2 (conceptos por categoría) y nivel3 (detalles por
+    categoría y concepto).
+    filtros: dict con keys opcionales: torre, piso, depto
     """
     conn = get_connection()
     cursor = conn.cursor()
 
-    query = """
-        SELECT
-            id,
-            detalle,
-            proveedor,
-            torre,
-            piso,
-            depto,
-            cantidad,
-            unidad,
-            total_mxn
-        FROM partidas
-        WHERE proyecto_id = ? AND categoria = ? AND concepto = ?
-    """
-    params = [proyecto_id, categoria, concepto]
-
-    if filtros:
-        if filtros.get('torre'):
-            query += " AND torre = ?"
-            params.append(filtros['torre'])
-        if filtros.get('piso'):
-            query += " AND piso = ?"
-            params.append(filtros['piso'])
-        if filtros.get('depto'):
-            query += " AND depto = ?"
-            params.append(filtros['depto'])
-
-    query += " ORDER BY total_mxn DESC"
-
-    cursor.execute(query, params)
-    detalles = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    campos = tuple(campo for campo in FILTROS_UBICACION if filtros and filtros.get(campo))
+    # Tuplas simples en lugar de sqlite3.Row: cada detalle se arma una sola vez
+    cursor.row_factory = None
+    cursor.execute(_sql_resumen_jerarquico(campos), [proyecto_id, *(filtros[campo] for campo in campos)])
+
+    categorias = {}
+    conceptos = {}
+    detalles = {}
+    total_partidas = 0
+    total_proyecto = None
+
+    # Una sola pasada: los detalles ya vienen ordenados por total_mxn
+    for row in cursor:
+        categoria, concepto, total_mxn = row[0], row[1], row[-1]
+        total_partidas += 1
+        if total_mxn is not None:
+            total_proyecto = (total_proyecto or 0) + total_mxn
+
+        _agregar_nivel(categorias, categoria, total_mxn)
+        _agregar_nivel(conceptos.setdefault(categoria, {}), concepto, total_mxn)
+
+        detalles.setdefault((categoria, concepto), []).append(dict(zip(CAMPOS_DETALLE, row[2:])))
+
+    nivel1 = _ordenar_por_total([
+        {'categoria': categoria, **grupo} for categoria, grupo in categorias.items()
+    ])
+    nivel2 = {
+        categoria: _ordenar_por_total([
+            {'concepto': concepto, **grupo} for concepto, grupo in grupos.items()
+        ])
+        for categoria, grupos in conceptos.items()
+    }
 
-    return {'detalles': detalles}
+    return {
+        'nivel1': {
+            'categorias': nivel1,
+            'num_categorias': sum(1 for categoria in categorias if categoria is not None),
+            'total_partidas': total_partidas,
+            'total_proyecto': total_proyecto or 0
+        },
+        'nivel2': nivel2,
+        'nivel3': detalles
+    }
 
 def obtener_deptos_proyecto(proyecto_id):
     """Obtener departamentos únicos de un proyecto"""
+    return _valores_distintos(proyecto_id, 'depto')
+
+def obtener_filtros_proyecto(proyecto_id):
+    """Obtener en una sola consulta los valores únicos de todos los filtros de un proyecto"""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT DISTINCT depto FROM partidas
-        WHERE proyecto_id = ? AND depto IS NOT NULL AND depto != ''
-        ORDER BY depto
+        SELECT DISTINCT torre, piso, proveedor, depto, categoria FROM partidas
+        WHERE proyecto_id = ?
     """, (proyecto_id,))
-    deptos = [row['depto'] for row in cursor.fetchall()]
-    conn.close()
-    return deptos
+    campos = ('torre', 'piso', 'proveedor', 'depto', 'categoria')
+    valores = {campo: set() for campo in campos}
+    for row in cursor:
+        for campo, valor in zip(campos, row):
+            if valor:
+                valores[campo].add(valor)
+    return {
+        'torres': sorted(valores['torre']),
+        'pisos': sorted(valores['piso']),
+        'proveedores': sorted(valores['proveedor']),
+        'deptos': sorted(valores['depto']),
+        'categorias': sorted(valores['categoria']),
+    }
 
 # ============== FUNCIONES CRUD PARA GLOSARIO ==============
 
@@ -736,144 +915,111 @@ def obtener_glosario_proyecto(proyecto_id):
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener categorías del proyecto
+    # Categorías y conceptos en una sola consulta; LEFT JOIN para conservar las
+    # categorías sin conceptos (con_id NULL)
     cursor.execute("""
-        SELECT id, nombre FROM glosario_categorias
-        WHERE proyecto_id = ?
-        ORDER BY nombre
+        SELECT gc.id AS cat_id, gc.nombre AS cat_nombre, gcp.id AS con_id, gcp.nombre AS con_nombre
+        FROM glosario_categorias gc
+        LEFT JOIN glosario_conceptos gcp ON gcp.categoria_id = gc.id
+        WHERE gc.proyecto_id = ?
+        ORDER BY gc.nombre, gcp.nombre
     """, (proyecto_id,))
-    categorias = cursor.fetchall()
 
     resultado = []
-    for cat in categorias:
-        # Obtener conceptos de cada categoría
-        cursor.execute("""
-            SELECT id, nombre FROM glosario_conceptos
-            WHERE categoria_id = ?
-            ORDER BY nombre
-        """, (cat['id'],))
-        conceptos = [{'id': con['id'], 'nombre': con['nombre']} for con in cursor.fetchall()]
-
+    for (cat_id, cat_nombre), filas in groupby(cursor, key=lambda row: (row['cat_id'], row['cat_nombre'])):
         resultado.append({
-            'id': cat['id'],
-            'categoria': cat['nombre'],
-            'conceptos': conceptos
+            'id': cat_id,
+            'categoria': cat_nombre,
+            'conceptos': [
+                {'id': row['con_id'], 'nombre': row['con_nombre']}
+                for row in filas if row['con_id'] is not None
+            ]
         })
 
-    conn.close()
     return resultado
 
 def agregar_categoria_glosario(proyecto_id, nombre):
     """Agregar una categoría al glosario del proyecto"""
     conn = get_connection()
     cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO glosario_categorias (proyecto_id, nombre)
-            VALUES (?, ?)
-        """, (proyecto_id, nombre.strip()))
-        conn.commit()
-        categoria_id = cursor.lastrowid
-        conn.close()
-        return {'id': categoria_id, 'nombre': nombre.strip()}
-    except sqlite3.IntegrityError:
-        conn.close()
+    # Si ya existe, OR IGNORE no inserta y RETURNING no devuelve fila
+    cursor.execute("""
+        INSERT OR IGNORE INTO glosario_categorias (proyecto_id, nombre)
+        VALUES (?, ?)
+        RETURNING id
+    """, (proyecto_id, nombre.strip()))
+    row = cursor.fetchone()
+    if not row:
         return None  # Ya existe
+    return {'id': row['id'], 'nombre': nombre.strip()}
 
 def eliminar_categoria_glosario(categoria_id):
     """Eliminar una categoría del glosario (cascade elimina conceptos)"""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM glosario_categorias WHERE id = ?", (categoria_id,))
-    conn.commit()
-    conn.close()
 
 def agregar_concepto_glosario(categoria_id, nombre):
     """Agregar un concepto a una categoría del glosario"""
     conn = get_connection()
     cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO glosario_conceptos (categoria_id, nombre)
-            VALUES (?, ?)
-        """, (categoria_id, nombre.strip()))
-        conn.commit()
-        concepto_id = cursor.lastrowid
-        conn.close()
-        return {'id': concepto_id, 'nombre': nombre.strip()}
-    except sqlite3.IntegrityError:
-        conn.close()
+    # Si ya existe, OR IGNORE no inserta y RETURNING no devuelve fila
+    cursor.execute("""
+        INSERT OR IGNORE INTO glosario_conceptos (categoria_id, nombre)
+        VALUES (?, ?)
+        RETURNING id
+    """, (categoria_id, nombre.strip()))
+    row = cursor.fetchone()
+    if not row:
         return None  # Ya existe
+    return {'id': row['id'], 'nombre': nombre.strip()}
 
 def eliminar_concepto_glosario(concepto_id):
     """Eliminar un concepto del glosario"""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM glosario_conceptos WHERE id = ?", (concepto_id,))
-    conn.commit()
-    conn.close()
 
 def importar_glosario_desde_partidas(proyecto_id):
     """Importar categorías y conceptos únicos desde las partidas existentes al glosario"""
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener categorías y conceptos únicos de las partidas
-    cursor.execute("""
-        SELECT DISTINCT categoria, concepto FROM partidas
-        WHERE proyecto_id = ?
-        AND categoria IS NOT NULL AND categoria != ''
-        AND concepto IS NOT NULL AND concepto != ''
-        ORDER BY categoria, concepto
-    """, (proyecto_id,))
-    partidas_data = cursor.fetchall()
+    importados = {}
 
-    importados = {'categorias': 0, 'conceptos': 0}
-
-    for row in partidas_data:
-        categoria_nombre = row['categoria']
-        concepto_nombre = row['concepto']
-
-        # Verificar si la categoría ya existe
+    # Dos sentencias por conjuntos en lugar de consultar e insertar par por par;
+    # UNIQUE + OR IGNORE descarta lo que ya existe y rowcount cuenta lo nuevo
+    with transaccion():
         cursor.execute("""
-            SELECT id FROM glosario_categorias
-            WHERE proyecto_id = ? AND nombre = ?
-        """, (proyecto_id, categoria_nombre))
-        cat_row = cursor.fetchone()
-
-        if cat_row:
-            categoria_id = cat_row['id']
-        else:
-            # Crear la categoría
-            cursor.execute("""
-                INSERT INTO glosario_categorias (proyecto_id, nombre)
-                VALUES (?, ?)
-            """, (proyecto_id, categoria_nombre))
-            categoria_id = cursor.lastrowid
-            importados['categorias'] += 1
-
-        # Verificar si el concepto ya existe en esa categoría
+            INSERT OR IGNORE INTO glosario_categorias (proyecto_id, nombre)
+            SELECT DISTINCT proyecto_id, categoria FROM partidas
+            WHERE proyecto_id = ?
+            AND categoria IS NOT NULL AND categoria != ''
+            AND concepto IS NOT NULL AND concepto != ''
+            ORDER BY categoria
+        """, (proyecto_id,))
+        importados['categorias'] = cursor.rowcount
+
         cursor.execute("""
-            SELECT id FROM glosario_conceptos
-            WHERE categoria_id = ? AND nombre = ?
-        """, (categoria_id, concepto_nombre))
-        con_row = cursor.fetchone()
-
-        if not con_row:
-            # Crear el concepto
-            cursor.execute("""
-                INSERT INTO glosario_conceptos (categoria_id, nombre)
-                VALUES (?, ?)
-            """, (categoria_id, concepto_nombre))
-            importados['conceptos'] += 1
-
-    conn.commit()
-    conn.close()
+            INSERT OR IGNORE INTO glosario_conceptos (categoria_id, nombre)
+            SELECT DISTINCT gc.id, p.concepto
+            FROM partidas p
+            JOIN glosario_categorias gc
+                ON gc.proyecto_id = p.proyecto_id AND gc.nombre = p.categoria
+            WHERE p.proyecto_id = ?
+            AND p.concepto IS NOT NULL AND p.concepto != ''
+            ORDER BY p.categoria, p.concepto
+        """, (proyecto_id,))
+        importados['conceptos'] = cursor.rowcount
+
     return importados
 
 def importar_glosario_desde_excel(proyecto_id, archivo_excel):
     """Importar glosario desde la hoja 'Glosario Partidas' de un archivo Excel"""
+    # Se ejecuta en el pool de trabajos: pandas no se carga en los workers web
+    import numpy as np
     import openpyxl
+    import pandas as pd
 
     try:
         wb = openpyxl.load_workbook(archivo_excel, read_only=True, data_only=True)
@@ -896,93 +1042,82 @@ def importar_glosario_desde_excel(proyecto_id, archivo_excel):
     if not glosario_sheet:
         return {'error': 'No se encontró la hoja de Glosario'}
 
+    # Leer sólo las columnas B y C, las únicas que se usan
+    rows = list(glosario_sheet.iter_rows(min_col=2, max_col=3, values_only=True))
+    wb.close()
+
+    # Primera pasada, por columnas: categorías principales (número entero del 1 al
+    # 50 en B, texto en C). Los textos de B no cuentan aunque parezcan números
+    celdas = pd.DataFrame(rows, columns=['b', 'c'], dtype=object)
+    # El tipo de cada celda de B se calcula una vez y sirve para las dos pasadas
+    tipos_b = celdas['b'].map(type)
+    numeros = pd.to_numeric(celdas['b'].where(tipos_b.isin((int, float, bool))), errors='coerce')
+    nombres = celdas['c'].astype('string').str.strip()
+    nombre_valido = (
+        nombres.ne('').fillna(False)
+        & ~nombres.str.contains('categor', case=False, regex=False).fillna(True)
+    )
+    es_categoria = (numeros == numeros.round()) & numeros.between(1, 50) & nombre_valido
+    nombres_cat = nombres[es_categoria]
+    # {nombre_normalizado: nombre_original}
+    categorias_principales = dict(zip(
+        nombres_cat.str.replace('_', ' ').str.lower().str.strip(), nombres_cat
+    ))
+
+    # Segunda pasada, también por columnas: encabezados de sección (texto en B que
+    # coincide con una categoría principal) y conceptos (número con decimales en B,
+    # texto válido en C) bajo la última sección vista
+    textos = celdas['b'].where(tipos_b.eq(str)).astype('string')
+    secciones = (
+        textos.str.strip().str.replace('_', ' ').str.lower().str.strip()
+        .map(categorias_principales)
+        .where(~textos.str.startswith('=').fillna(True))
+    )
+    seccion_actual = secciones.ffill()
+    es_concepto = (
+        seccion_actual.notna() & ((numeros - np.trunc(numeros)).abs() > 0.001) & nombre_valido
+    )
+
+    # {nombre_categoria: [conceptos]}, en el orden de aparición; si una sección se
+    # repite, sus conceptos se juntan
+    glosario = {nombre: [] for nombre in secciones.dropna()}
+    for seccion, concepto in zip(seccion_actual[es_concepto], nombres[es_concepto]):
+        glosario[seccion].append(concepto)
+
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Primero eliminar glosario existente del proyecto
-    cursor.execute("""
-        DELETE FROM glosario_conceptos WHERE categoria_id IN (
-            SELECT id FROM glosario_categorias WHERE proyecto_id = ?
-        )
-    """, (proyecto_id,))
-    cursor.execute("DELETE FROM glosario_categorias WHERE proyecto_id = ?", (proyecto_id,))
-
     importados = {'categorias': 0, 'conceptos': 0}
 
-    # Leer todas las filas
-    rows = list(glosario_sheet.iter_rows(values_only=True))
+    # Reemplazar el glosario en una sola transacción: si algo falla, el proyecto
+    # conserva el glosario anterior
+    with transaccion():
+        cursor.execute("""
+            DELETE FROM glosario_conceptos WHERE categoria_id IN (
+                SELECT id FROM glosario_categorias WHERE proyecto_id = ?
+            )
+        """, (proyecto_id,))
+        cursor.execute("DELETE FROM glosario_categorias WHERE proyecto_id = ?", (proyecto_id,))
 
-    # Primera pasada: recopilar categorías principales (número entero en B, texto en C)
-    categorias_principales = {}  # {nombre_normalizado: nombre_original}
+        cursor.executemany("""
+            INSERT INTO glosario_categorias (proyecto_id, nombre)
+            VALUES (?, ?)
+        """, [(proyecto_id, nombre) for nombre in glosario])
+        importados['categorias'] = cursor.rowcount
 
-    for row in rows:
-        if len(row) < 3:
-            continue
+        cursor.execute("SELECT id, nombre FROM glosario_categorias WHERE proyecto_id = ?", (proyecto_id,))
+        ids_categorias = {row['nombre']: row['id'] for row in cursor.fetchall()}
 
-        col_b = row[1]
-        col_c = row[2]
-
-        if col_b is not None and col_c is not None:
-            try:
-                num = float(col_b) if not isinstance(col_b, str) else None
-                if num is not None and num == int(num) and 1 <= int(num) <= 50:
-                    nombre_cat = str(col_c).strip()
-                    if nombre_cat and 'categor' not in nombre_cat.lower():
-                        nombre_normalizado = nombre_cat.replace('_', ' ').lower().strip()
-                        categorias_principales[nombre_normalizado] = nombre_cat
-            except (ValueError, TypeError):
-                pass
-
-    # Segunda pasada: procesar secciones y conceptos
-    categoria_id_actual = None
-
-    for row in rows:
-        if len(row) < 3:
-            continue
-
-        col_b = row[1]
-        col_c = row[2]
-
-        # Detectar encabezado de sección (texto en B que coincide con categoría conocida)
-        if col_b is not None and isinstance(col_b, str) and not col_b.startswith('='):
-            nombre_seccion = col_b.strip()
-            nombre_normalizado = nombre_seccion.replace('_', ' ').lower().strip()
-
-            if nombre_normalizado in categorias_principales:
-                # Crear nueva categoría
-                nombre_original = categorias_principales[nombre_normalizado]
-                cursor.execute("""
-                    INSERT INTO glosario_categorias (proyecto_id, nombre)
-                    VALUES (?, ?)
-                """, (proyecto_id, nombre_original))
-                categoria_id_actual = cursor.lastrowid
-                importados['categorias'] += 1
-                continue
-
-        # Detectar concepto (número decimal en B, texto válido en C)
-        if categoria_id_actual and col_b is not None and col_c is not None:
-            try:
-                num = float(col_b) if not isinstance(col_b, str) else None
-                if num is not None:
-                    # Verificar que tiene parte decimal significativa
-                    parte_decimal = abs(num - int(num))
-                    if parte_decimal > 0.001:
-                        nombre_concepto = str(col_c).strip()
-                        if nombre_concepto and 'categor' not in nombre_concepto.lower():
-                            try:
-                                cursor.execute("""
-                                    INSERT INTO glosario_conceptos (categoria_id, nombre)
-                                    VALUES (?, ?)
-                                """, (categoria_id_actual, nombre_concepto))
-                                importados['conceptos'] += 1
-                            except sqlite3.IntegrityError:
-                                pass  # Ya existe
-            except (ValueError, TypeError):
-                pass
-
-    conn.commit()
-    conn.close()
-    wb.close()
+        # Los conceptos repetidos dentro de una categoría se ignoran
+        cursor.executemany("""
+            INSERT OR IGNORE INTO glosario_conceptos (categoria_id, nombre)
+            VALUES (?, ?)
+        """, [
+            (ids_categorias[categoria], concepto)
+            for categoria, conceptos in glosario.items()
+            for concepto in conceptos
+        ])
+        importados['conceptos'] = cursor.rowcount
 
     return importados
 
@@ -997,37 +1132,27 @@ def obtener_proveedores_por_categoria_global():
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener todas las combinaciones únicas de categoría-proveedor
+    # Una fila por categoría con sus proveedores únicos concatenados; el separador
+    # (CHAR(31)) no aparece en nombres de proveedor, a diferencia de la coma
     cursor.execute("""
-        SELECT DISTINCT categoria, proveedor
-        FROM partidas
-        WHERE categoria IS NOT NULL AND categoria != ''
-        AND proveedor IS NOT NULL AND proveedor != ''
-        ORDER BY categoria, proveedor
+        SELECT categoria, GROUP_CONCAT(proveedor, CHAR(31)) AS proveedores
+        FROM (
+            SELECT DISTINCT categoria, proveedor
+            FROM partidas
+            WHERE categoria IS NOT NULL AND categoria != ''
+            AND proveedor IS NOT NULL AND proveedor != ''
+        )
+        GROUP BY categoria
+        ORDER BY categoria
     """)
 
-    resultados = cursor.fetchall()
-    conn.close()
-
-    # Agrupar por categoría
-    categorias_dict = {}
-    for row in resultados:
-        categoria = row['categoria']
-        proveedor = row['proveedor']
-
-        if categoria not in categorias_dict:
-            categorias_dict[categoria] = []
-
-        if proveedor not in categorias_dict[categoria]:
-            categorias_dict[categoria].append(proveedor)
-
-    # Convertir a lista para JSON
     resultado = []
-    for categoria in sorted(categorias_dict.keys()):
+    for categoria, proveedores in cursor.fetchall():
+        proveedores = sorted(proveedores.split('\x1f'))
         resultado.append({
             'categoria': categoria,
-            'proveedores': sorted(categorias_dict[categoria]),
-            'num_proveedores': len(categorias_dict[categoria])
+            'proveedores': proveedores,
+            'num_proveedores': len(proveedores)
         })
 
     return resultado
@@ -1067,7 +1192,6 @@ def obtener_estadisticas_proveedor(proveedor):
     """, (proveedor,))
 
     totales = dict(cursor.fetchone())
-    conn.close()
 
     return {
         'proveedor': proveedor,
@@ -1079,28 +1203,55 @@ def obtener_estadisticas_proveedor(proveedor):
 
 # ============== FUNCIONES CRUD PARA COTIZACIONES ==============
 
-import json
-
 def crear_cotizacion(proyecto_id, proveedor, categorias=None, archivo_nombre=None,
-                     fecha_cotizacion=None, moneda='MXN', notas=None):
+                     fecha_cotizacion=None, moneda='MXN', notas=None, archivo_hash=None):
     """Crear una nueva cotización"""
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Convertir lista de categorías a JSON
-    categorias_json = json.dumps(categorias) if categorias else None
+    with transaccion():
+        cursor.execute("""
+            INSERT INTO cotizaciones (proyecto_id, proveedor, archivo_nombre,
+                                      fecha_cotizacion, moneda, notas, archivo_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (proyecto_id, proveedor, archivo_nombre,
+              fecha_cotizacion, moneda, notas, archivo_hash))
+
+        cotizacion_id = cursor.lastrowid
+        _guardar_categorias_cotizacion(cursor, cotizacion_id, categorias)
+    return cotizacion_id
+
+def _guardar_categorias_cotizacion(cursor, cotizacion_id, categorias):
+    """Registrar las categorías de una cotización en cotizacion_categorias"""
+    if isinstance(categorias, str):
+        categorias = [categorias]
+    cursor.executemany("""
+        INSERT OR IGNORE INTO cotizacion_categorias (cotizacion_id, categoria) VALUES (?, ?)
+    """, [(cotizacion_id, categoria) for categoria in categorias or () if isinstance(categoria, str) and categoria])
+
+def _categorias_de_cotizaciones(cursor, ids):
+    """{cotizacion_id: [categorías]} para las cotizaciones dadas, en el orden en que se guardaron"""
+    categorias = {}
+    cursor.execute(f"""
+        SELECT cotizacion_id, categoria FROM cotizacion_categorias
+        WHERE cotizacion_id IN ({SQL_IDS_JSON})
+        ORDER BY rowid
+    """, (_ids_json(ids),))
+    for cotizacion_id, categoria in cursor.fetchall():
+        categorias.setdefault(cotizacion_id, []).append(categoria)
+    return categorias
 
+def buscar_cotizacion_por_hash(proyecto_id, proveedor, archivo_hash):
+    """Obtener el id de una cotización ya cargada con el mismo archivo (None si no hay)"""
+    conn = get_connection()
+    cursor = conn.cursor()
     cursor.execute("""
-        INSERT INTO cotizaciones (proyecto_id, proveedor, categorias, archivo_nombre,
-                                  fecha_cotizacion, moneda, notas)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (proyecto_id, proveedor, categorias_json, archivo_nombre,
-          fecha_cotizacion, moneda, notas))
-
-    conn.commit()
-    cotizacion_id = cursor.lastrowid
-    conn.close()
-    return cotizacion_id
+        SELECT id FROM cotizaciones
+        WHERE archivo_hash = ? AND proyecto_id = ? AND proveedor = ?
+        ORDER BY id DESC LIMIT 1
+    """, (archivo_hash, proyecto_id, proveedor))
+    row = cursor.fetchone()
+    return row['id'] if row else None
 
 def obtener_cotizaciones(proyecto_id=None, proveedor=None, categoria=None):
     """Obtener cotizaciones con filtros opcionales"""
@@ -1124,27 +1275,18 @@ def obtener_cotizaciones(proyecto_id=None, proveedor=None, categoria=None):
         params.append(proveedor)
 
     if categoria:
-        # Buscar en el JSON de categorías
-        query += " AND c.categorias LIKE ?"
-        params.append(f'%"{categoria}"%')
+        query += " AND c.id IN (SELECT cotizacion_id FROM cotizacion_categorias WHERE categoria = ?)"
+        params.append(categoria)
 
     query += " ORDER BY c.fecha_carga DESC"
 
     cursor.execute(query, params)
-    cotizaciones = []
-    for row in cursor.fetchall():
-        cot = dict(row)
-        # Parsear categorías de JSON
-        if cot.get('categorias'):
-            try:
-                cot['categorias'] = json.loads(cot['categorias'])
-            except:
-                cot['categorias'] = []
-        else:
-            cot['categorias'] = []
-        cotizaciones.append(cot)
-
-    conn.close()
+    cotizaciones = [dict(row) for row in cursor.fetchall()]
+
+    categorias = _categorias_de_cotizaciones(cursor, [cot['id'] for cot in cotizaciones])
+    for cot in cotizaciones:
+        cot['categorias'] = categorias.get(cot['id'], [])
+
     return cotizaciones
 
 def obtener_cotizacion(cotizacion_id):
@@ -1158,17 +1300,10 @@ def obtener_cotizacion(cotizacion_id):
         WHERE c.id = ?
     """, (cotizacion_id,))
     row = cursor.fetchone()
-    conn.close()
 
     if row:
         cot = dict(row)
-        if cot.get('categorias'):
-            try:
-                cot['categorias'] = json.loads(cot['categorias'])
-            except:
-                cot['categorias'] = []
-        else:
-            cot['categorias'] = []
+        cot['categorias'] = _categorias_de_cotizaciones(cursor, [cotizacion_id]).get(cotizacion_id, [])
         return cot
     return None
 
@@ -1177,67 +1312,61 @@ def actualizar_cotizacion(cotizacion_id, datos):
     conn = get_connection()
     cursor = conn.cursor()
 
-    categorias_json = json.dumps(datos.get('categorias')) if datos.get('categorias') else None
-
-    cursor.execute("""
-        UPDATE cotizaciones SET
-            proveedor = ?,
-            categorias = ?,
-            fecha_cotizacion = ?,
-            moneda = ?,
-            notas = ?
-        WHERE id = ?
-    """, (
-        datos.get('proveedor'),
-        categorias_json,
-        datos.get('fecha_cotizacion'),
-        datos.get('moneda', 'MXN'),
-        datos.get('notas'),
-        cotizacion_id
-    ))
+    with transaccion():
+        cursor.execute("""
+            UPDATE cotizaciones SET
+                proveedor = ?,
+                fecha_cotizacion = ?,
+                moneda = ?,
+                notas = ?
+            WHERE id = ?
+        """, (
+            datos.get('proveedor'),
+            datos.get('fecha_cotizacion'),
+            datos.get('moneda', 'MXN'),
+            datos.get('notas'),
+            cotizacion_id
+        ))
 
-    conn.commit()
-    conn.close()
+        cursor.execute("DELETE FROM cotizacion_categorias WHERE cotizacion_id = ?", (cotizacion_id,))
+        _guardar_categorias_cotizacion(cursor, cotizacion_id, datos.get('categorias'))
 
 def eliminar_cotizacion(cotizacion_id):
     """Eliminar una cotización y sus items"""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM cotizaciones WHERE id = ?", (cotizacion_id,))
-    conn.commit()
-    conn.close()
+    # Las claves foráneas no están activas: las categorías se borran aquí
+    with transaccion():
+        cursor.execute("DELETE FROM cotizacion_categorias WHERE cotizacion_id = ?", (cotizacion_id,))
+        cursor.execute("DELETE FROM cotizaciones WHERE id = ?", (cotizacion_id,))
 
 def actualizar_totales_cotizacion(cotizacion_id):
-    """Actualizar num_items y total de una cotización"""
+    """
+    Recalcular num_items y total de una cotización desde sus items. Los triggers
+    de cotizacion_items los mantienen al día; esto sólo sirve para conciliar
+    """
     conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT COUNT(*) as num, COALESCE(SUM(importe), 0) as total
-        FROM cotizacion_items WHERE cotizacion_id = ?
+    # Un solo UPDATE con subconsultas: no hace falta leer los totales a Python
+    conn.execute("""
+        UPDATE cotizaciones SET
+            num_items = (SELECT COUNT(*) FROM cotizacion_items WHERE cotizacion_id = ?1),
+            total = (SELECT COALESCE(SUM(importe), 0) FROM cotizacion_items WHERE cotizacion_id = ?1)
+        WHERE id = ?1
     """, (cotizacion_id,))
-    row = cursor.fetchone()
-
-    cursor.execute("""
-        UPDATE cotizaciones SET num_items = ?, total = ? WHERE id = ?
-    """, (row['num'], row['total'], cotizacion_id))
-
-    conn.commit()
-    conn.close()
 
 # ============== FUNCIONES CRUD PARA ITEMS DE COTIZACION ==============
 
-def crear_items_cotizacion(cotizacion_id, items):
-    """Crear múltiples items para una cotización"""
+def crear_items_cotizacion(cotizacion_id, items, moneda=None):
+    """Crear múltiples items para una cotización (moneda, si se indica, aplica a todos)"""
     conn = get_connection()
     cursor = conn.cursor()
 
-    for item in items:
-        cursor.execute("""
+    with transaccion():
+        cursor.executemany("""
             INSERT INTO cotizacion_items (cotizacion_id, codigo, descripcion, unidad,
                                           cantidad, precio_unitario, importe, moneda)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        """, [(
             cotizacion_id,
             item.get('codigo'),
             item.get('descripcion', ''),
@@ -1245,14 +1374,8 @@ def crear_items_cotizacion(cotizacion_id, items):
             item.get('cantidad'),
             item.get('precio_unitario'),
             item.get('importe'),
-            item.get('moneda', 'MXN')
-        ))
-
-    conn.commit()
-    conn.close()
-
-    # Actualizar totales
-    actualizar_totales_cotizacion(cotizacion_id)
+            moneda or item.get('moneda', 'MXN')
+        ) for item in items])
 
 def obtener_items_cotizacion(cotizacion_id):
     """Obtener items de una cotización"""
@@ -1264,7 +1387,6 @@ def obtener_items_cotizacion(cotizacion_id):
         ORDER BY id
     """, (cotizacion_id,))
     items = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return items
 
 def actualizar_item_cotizacion(item_id, datos):
@@ -1272,11 +1394,7 @@ def actualizar_item_cotizacion(item_id, datos):
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener cotizacion_id antes de actualizar
-    cursor.execute("SELECT cotizacion_id FROM cotizacion_items WHERE id = ?", (item_id,))
-    row = cursor.fetchone()
-    cotizacion_id = row['cotizacion_id'] if row else None
-
+    # Los totales de la cotización los ajusta el trigger
     cursor.execute("""
         UPDATE cotizacion_items SET
             codigo = ?,
@@ -1298,30 +1416,13 @@ def actualizar_item_cotizacion(item_id, datos):
         item_id
     ))
 
-    conn.commit()
-    conn.close()
-
-    # Actualizar totales de la cotización
-    if cotizacion_id:
-        actualizar_totales_cotizacion(cotizacion_id)
-
 def eliminar_item_cotizacion(item_id):
     """Eliminar un item de cotización"""
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener cotizacion_id antes de eliminar
-    cursor.execute("SELECT cotizacion_id FROM cotizacion_items WHERE id = ?", (item_id,))
-    row = cursor.fetchone()
-    cotizacion_id = row['cotizacion_id'] if row else None
-
+    # Los totales de la cotización los ajusta el trigger
     cursor.execute("DELETE FROM cotizacion_items WHERE id = ?", (item_id,))
-    conn.commit()
-    conn.close()
-
-    # Actualizar totales
-    if cotizacion_id:
-        actualizar_totales_cotizacion(cotizacion_id)
 
 # ============== FUNCIONES PARA COMPARACION DE UNITARIOS ==============
 
@@ -1335,7 +1436,6 @@ def obtener_proveedores_cotizaciones():
         ORDER BY proveedor
     """)
     proveedores = [row['proveedor'] for row in cursor.fetchall()]
-    conn.close()
     return proveedores
 
 def comparar_unitarios(proveedor, categoria=None):
@@ -1346,63 +1446,50 @@ def comparar_unitarios(proveedor, categoria=None):
     conn = get_connection()
     cursor = conn.cursor()
 
-    # Obtener todas las cotizaciones del proveedor
+    # Cotizaciones del proveedor con sus items en una sola consulta (LEFT JOIN para
+    # conservar los proyectos cuyas cotizaciones no tienen items)
     query = """
-        SELECT c.id, c.proyecto_id, p.nombre as proyecto_nombre, c.categorias
+        SELECT c.proyecto_id, p.nombre, ci.descripcion, ci.unidad, ci.precio_unitario
         FROM cotizaciones c
         JOIN proyectos p ON c.proyecto_id = p.id
+        LEFT JOIN cotizacion_items ci ON ci.cotizacion_id = c.id
         WHERE c.proveedor = ?
     """
     params = [proveedor]
 
     if categoria:
-        query += " AND c.categorias LIKE ?"
-        params.append(f'%"{categoria}"%')
-
-    cursor.execute(query, params)
-    cotizaciones = cursor.fetchall()
-
-    if not cotizaciones:
-        conn.close()
-        return {'items': [], 'proyectos': []}
-
-    # Obtener IDs de cotizaciones
-    cotizacion_ids = [c['id'] for c in cotizaciones]
-    proyectos_dict = {c['proyecto_id']: c['proyecto_nombre'] for c in cotizaciones}
+        query += " AND c.id IN (SELECT cotizacion_id FROM cotizacion_categorias WHERE categoria = ?)"
+        params.append(categoria)
 
-    # Obtener todos los items de esas cotizaciones
-    placeholders = ','.join('?' * len(cotizacion_ids))
-    cursor.execute(f"""
-        SELECT ci.*, c.proyecto_id
-        FROM cotizacion_items ci
-        JOIN cotizaciones c ON ci.cotizacion_id = c.id
-        WHERE ci.cotizacion_id IN ({placeholders})
-        ORDER BY ci.descripcion
-    """, cotizacion_ids)
+    query += " ORDER BY ci.descripcion, ci.id"
 
-    items = cursor.fetchall()
-    conn.close()
+    cursor.row_factory = None
+    cursor.execute(query, params)
 
-    # Agrupar por descripción normalizada
+    # Agrupar por descripción normalizada. La normalización se queda en Python:
+    # UPPER y TRIM de SQLite sólo cubren ASCII y espacios, y las descripciones
+    # llevan acentos
+    proyectos_dict = {}
     comparacion = {}
-    for item in items:
-        desc = item['descripcion'].strip().upper() if item['descripcion'] else ''
+    for proyecto_id, proyecto_nombre, descripcion, unidad, precio_unitario in cursor:
+        proyectos_dict[proyecto_id] = proyecto_nombre
+
+        desc = descripcion.strip().upper() if descripcion else ''
         if not desc:
             continue
 
         if desc not in comparacion:
             comparacion[desc] = {
-                'descripcion': item['descripcion'],
-                'unidad': item['unidad'],
+                'descripcion': descripcion,
+                'unidad': unidad,
                 'precios': {}
             }
 
-        proyecto_id = item['proyecto_id']
-        proyecto_nombre = proyectos_dict.get(proyecto_id, f'Proyecto {proyecto_id}')
+        # Guardar precio unitario por proyecto (el primero que aparezca)
+        comparacion[desc]['precios'].setdefault(proyecto_nombre, precio_unitario)
 
-        # Guardar precio unitario por proyecto
-        if proyecto_nombre not in comparacion[desc]['precios']:
-            comparacion[desc]['precios'][proyecto_nombre] = item['precio_unitario']
+    if not proyectos_dict:
+        return {'items': [], 'proyectos': []}
 
     # Convertir a lista y calcular diferencias
     resultado = []
@@ -1438,5 +1525,72 @@ def comparar_unitarios(proveedor, categoria=None):
         'proveedor': proveedor
     }
 
+# ============== TRABAJOS EN SEGUNDO PLANO ==============
+
+# Un trabajo lo finaliza el worker web que lo encoló; si ese worker se reinicia o
+# muere antes, la fila quedaría 'en_proceso' para siempre. Pasado este tiempo desde
+# que empezó a ejecutarse se da por perdido (las importaciones tardan segundos)
+TIEMPO_MAXIMO_TRABAJO_S = 15 * 60
+LIMITE_TRABAJO_ABANDONADO = f"-{TIEMPO_MAXIMO_TRABAJO_S} seconds"
+
+CONDICION_TRABAJO_ABANDONADO = "estado = 'en_proceso' AND fecha_modificacion < datetime('now', ?)"
+RESULTADO_TRABAJO_ABANDONADO = orjson.dumps({'error': 'El trabajo no terminó: el proceso que lo ejecutaba se detuvo'}).decode()
+
+def crear_trabajo(trabajo_id, tipo):
+    """Registrar un trabajo en segundo plano en estado 'en_proceso'"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO trabajos (id, tipo) VALUES (?, ?)", (trabajo_id, tipo))
+
+def iniciar_trabajo(trabajo_id):
+    """Marcar el momento en que el pool empieza a ejecutar el trabajo (el tiempo en cola no cuenta)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE trabajos SET fecha_modificacion = CURRENT_TIMESTAMP
+        WHERE id = ? AND estado = 'en_proceso'
+    """, (trabajo_id,))
+
+def finalizar_trabajo(trabajo_id, estado, resultado):
+    """Guardar el estado final ('completado' o 'error') y el resultado de un trabajo"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE trabajos SET estado = ?, resultado = ?, fecha_modificacion = CURRENT_TIMESTAMP
+        WHERE id = ?
+    """, (estado, orjson.dumps(resultado, option=orjson.OPT_NON_STR_KEYS).decode(), trabajo_id))
+
+def marcar_trabajos_abandonados():
+    """Pasar a 'error' los trabajos que llevan demasiado tiempo 'en_proceso' (al arrancar el servidor)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        UPDATE trabajos SET estado = 'error', resultado = ?, fecha_modificacion = CURRENT_TIMESTAMP
+        WHERE {CONDICION_TRABAJO_ABANDONADO}
+    """, (RESULTADO_TRABAJO_ABANDONADO, LIMITE_TRABAJO_ABANDONADO))
+    return cursor.rowcount
+
+def obtener_trabajo(trabajo_id):
+    """
+    Obtener el estado y resultado de un trabajo. Sólo lectura: se consulta cada
+    segundo mientras el trabajo corre, así que un trabajo abandonado se informa
+    como 'error' sin escribirlo (no compite por el bloqueo de escritura)
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, tipo,
+               CASE WHEN {CONDICION_TRABAJO_ABANDONADO} THEN 'error' ELSE estado END AS estado,
+               CASE WHEN {CONDICION_TRABAJO_ABANDONADO} THEN ? ELSE resultado END AS resultado,
+               fecha_creacion, fecha_modificacion
+        FROM trabajos WHERE id = ?
+    """, (LIMITE_TRABAJO_ABANDONADO, LIMITE_TRABAJO_ABANDONADO, RESULTADO_TRABAJO_ABANDONADO, trabajo_id))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    trabajo = dict(row)
+    trabajo['resultado'] = orjson.loads(trabajo['resultado']) if trabajo['resultado'] else None
+    return trabajo
+
 if __name__ == "__main__":
     init_database()
@@ -9,6 +9,14 @@ import os
 from pathlib import Path
 import pandas as pd
 
+# Códigos que en realidad son celdas vacías (subtotales, totales)
+CODIGOS_VACIOS = frozenset({'nan', 'none', ''})
+
+
+def es_vacio(valor):
+    """Celda vacía (None o NaN) sin pasar por pd.isna, que es lento para un escalar"""
+    return valor is None or (isinstance(valor, float) and valor != valor)
+
 
 def extraer_items_excel(archivo_path):
     """
@@ -86,7 +94,7 @@ def extraer_items_excel(archivo_path):
 
             desc = row.iloc[desc_idx] if desc_idx < len(row) else None
 
-            if pd.isna(desc):
+            if es_vacio(desc):
                 continue
             desc_str = str(desc).strip()
             if desc_str == '' or len(desc_str) < 5:
@@ -100,7 +108,7 @@ def extraer_items_excel(archivo_path):
                 if idx is None or idx >= len(row):
                     return None
                 val = row.iloc[idx]
-                return None if pd.isna(val) else val
+                return None if es_vacio(val) else val
 
             def get_num(campo):
                 val = get_val(campo)
@@ -119,7 +127,7 @@ def extraer_items_excel(archivo_path):
 
             # Validar que tenga codigo (ignorar subtotales y totales que no tienen codigo)
             codigo_str = str(codigo).strip() if codigo else ''
-            if not codigo_str or codigo_str.lower() in ['nan', 'none', '']:
+            if not codigo_str or codigo_str.lower() in CODIGOS_VACIOS:
                 continue
 
             # Solo agregar si tiene descripcion, codigo y al menos un numero
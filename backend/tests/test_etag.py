@@ -0,0 +1,69 @@
+"""
+ETag por versión de las partidas (etag_por_version) y su cache.
+
+Uso (desde el directorio backend):
+    python -m unittest discover tests
+"""
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import models  # noqa: E402
+
+# Base temporal antes de importar app: al importarse crea el esquema en DATABASE_PATH
+_directorio = tempfile.TemporaryDirectory()
+models.usar_base_datos(Path(_directorio.name) / "test.db")
+
+import app as app_modulo  # noqa: E402
+
+
+class EtagPorVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        app_modulo.cache.clear()
+        self.cliente = app_modulo.app.test_client()
+        self.proyecto_id = models.crear_proyecto(f"Proyecto {self.id()}")
+        models.crear_partida(self.proyecto_id, {'categoria': 'Obra Civil', 'cantidad': 1, 'unitario': 10})
+        self.url = f"/api/proyectos/{self.proyecto_id}/resumen"
+
+    def etag_actual(self):
+        respuesta = self.cliente.get(self.url, headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta.get_etag()[0]
+
+    def test_304_sin_consultar_con_etag_comprimido(self):
+        """El ETag con sufijo de flask-compress (':br', ':gzip') también responde 304 sin consultar"""
+        etag = self.etag_actual()
+        for algoritmo in ('br', 'gzip'):
+            app_modulo.cache.clear()
+            with self.subTest(algoritmo=algoritmo), \
+                    mock.patch.object(app_modulo, 'obtener_resumen_proyecto') as resumen:
+                respuesta = self.cliente.get(self.url, headers={
+                    'Accept-Encoding': algoritmo,
+                    'If-None-Match': f'"{etag}:{algoritmo}"',
+                })
+                self.assertEqual(respuesta.status_code, 304)
+                resumen.assert_not_called()
+
+    def test_cambio_fuera_del_proceso_no_sirve_cuerpo_viejo(self):
+        """Un cambio que no limpia esta cache (otro worker, importación) cambia ETag y cuerpo"""
+        etag = self.etag_actual()
+        # Escritura directa, sin pasar por la app ni por invalidar_cache
+        models.crear_partida(self.proyecto_id, {'categoria': 'Acabados', 'cantidad': 1, 'unitario': 5})
+
+        respuesta = self.cliente.get(self.url, headers={
+            'Accept-Encoding': 'identity',
+            'If-None-Match': f'"{etag}"',
+        })
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotEqual(respuesta.get_etag()[0], etag)
+        categorias = [fila['categoria'] for fila in respuesta.get_json()['categorias']]
+        self.assertIn('Acabados', categorias)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tareas largas que se ejecutan en el pool de trabajos en segundo plano.
+Deben ser funciones de módulo (se envían por pickle a otro proceso).
+"""
+import os
+import sqlite3
+from pathlib import Path
+
+from models import (
+    buscar_cotizacion_por_hash, crear_cotizacion, crear_items_cotizacion,
+    iniciar_trabajo, obtener_cotizacion, obtener_items_cotizacion, transaccion
+)
+
+
+def ejecutar_trabajo(trabajo_id, funcion, *args):
+    """Ejecutar un trabajo encolado, marcando antes cuándo empezó de verdad"""
+    iniciar_trabajo(trabajo_id)
+    return funcion(*args)
+
+
+def resultado_cotizacion_duplicada(cotizacion_id):
+    """Resultado de trabajo para un archivo que ya estaba cargado como esa cotización"""
+    return {
+        'cotizacion': obtener_cotizacion(cotizacion_id),
+        'items': obtener_items_cotizacion(cotizacion_id),
+        'num_paginas': None,
+        'errores': [],
+        'duplicada': True
+    }
+
+
+def procesar_cotizacion_excel(archivo_path, nombre_archivo, datos_cotizacion):
+    """
+    Extraer los items de un Excel de cotización ya guardado en disco y registrar
+    la cotización. El archivo se renombra a cotizacion_<id><ext> si todo sale bien
+    y se elimina si falla.
+    """
+    # pandas sólo se carga en el proceso de trabajos, no en cada worker web
+    from pdf_processor import extraer_items_excel
+
+    archivo_path = Path(archivo_path)
+    try:
+        resultado = extraer_items_excel(archivo_path)
+
+        if resultado['errores'] and not resultado['items']:
+            archivo_path.unlink(missing_ok=True)
+            return {
+                'error': 'Error procesando Excel',
+                'detalles': resultado['errores']
+            }
+
+        # Cotización e items juntos: si algo falla no queda una cotización vacía
+        # con el hash del archivo (que haría pasar las siguientes subidas por duplicadas)
+        try:
+            with transaccion():
+                cotizacion_id = crear_cotizacion(archivo_nombre=nombre_archivo, **datos_cotizacion)
+
+                if resultado['items']:
+                    crear_items_cotizacion(cotizacion_id, resultado['items'], datos_cotizacion['moneda'])
+        except sqlite3.IntegrityError:
+            # Otra subida del mismo archivo se registró mientras éste se procesaba
+            cotizacion_id = buscar_cotizacion_por_hash(
+                datos_cotizacion['proyecto_id'], datos_cotizacion['proveedor'],
+                datos_cotizacion.get('archivo_hash')
+            )
+            if not cotizacion_id:
+                raise
+            archivo_path.unlink(missing_ok=True)
+            return resultado_cotizacion_duplicada(cotizacion_id)
+    except BaseException:
+        archivo_path.unlink(missing_ok=True)
+        raise
+
+    # Sólo después del commit: el archivo nunca apunta a una cotización que no existe
+    os.replace(archivo_path, archivo_path.with_name(f"cotizacion_{cotizacion_id}{archivo_path.suffix}"))
+
+    return {
+        'cotizacion': obtener_cotizacion(cotizacion_id),
+        'items': resultado['items'],
+        'num_paginas': resultado['num_paginas'],
+        'errores': resultado['errores']
+    }
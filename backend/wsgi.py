@@ -0,0 +1,14 @@
+"""
+Punto de entrada WSGI para producción.
+
+Uso (desde el directorio backend):
+    gunicorn -w 4 -k gthread --threads 8 --timeout 60 wsgi:app
+
+La cache de respuestas se guarda en archivos y la comparten los workers del
+mismo equipo. Con varios equipos configurar una cache común con
+FLASK_CACHE_TYPE=RedisCache y FLASK_CACHE_REDIS_URL=redis://localhost:6379/0.
+
+Lo mismo aplica a /metrics: cada worker expone sólo sus propias métricas, así
+que Prometheus debe agregarlas por instancia o apuntar a un único worker.
+"""
+from app import app
@@ -0,0 +1,28 @@
+"""
+Punto de entrada WSGI con gevent para muchas conexiones concurrentes por worker.
+
+Uso (desde el directorio backend):
+    gunicorn -k gevent -w 4 --worker-connections 1000 --timeout 60 wsgi_gevent:application
+
+monkey.patch_all() debe ejecutarse antes de importar Flask o la app. Con el parche,
+threading.local pasa a ser local a cada greenlet: cada petición abre su propia
+conexión SQLite, que se cierra al terminar la petición. Las consultas a SQLite
+siguen bloqueando mientras se ejecutan (es una extensión en C); gevent sólo
+alterna greenlets mientras esperan red (clientes lentos, uploads). Si dos
+escrituras coinciden, busy_timeout hace que la segunda espere hasta 5 s en vez
+de fallar con "database is locked".
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import models  # noqa: E402
+from app import app  # noqa: E402
+
+application = app
+
+
+@app.teardown_appcontext
+def cerrar_conexion_greenlet(exc):
+    """Cerrar la conexión de la petición: los greenlets no se reutilizan como los hilos"""
+    models.cerrar_conexion()
@@ -847,11 +847,7 @@ async function mostrarFiltrosBeachfront() {
     // Verificar si el proyecto tiene torres, pisos o deptos
     if (estado.proyectoActual) {
         try {
-            const [torres, pisos, deptos] = await Promise.all([
-                fetchAPI(`/proyectos/${estado.proyectoActual}/torres`),
-                fetchAPI(`/proyectos/${estado.proyectoActual}/pisos`),
-                fetchAPI(`/proyectos/${estado.proyectoActual}/deptos`)
-            ]);
+            const { torres, pisos, deptos } = await fetchAPI(`/proyectos/${estado.proyectoActual}/filtros`);
 
             const tieneFiltros = (torres && torres.length > 0) ||
                                (pisos && pisos.length > 0) ||
@@ -1016,6 +1012,19 @@ function renderizarGlosario() {
     `).join('');
 }
 
+// Consultar un trabajo en segundo plano hasta que termine (como mucho ~15 min,
+// el mismo límite tras el cual el servidor lo da por perdido)
+async function esperarTrabajo(trabajoId, intervaloMs = 1000, maxIntentos = 900) {
+    for (let intento = 0; intento < maxIntentos; intento++) {
+        const trabajo = await fetchAPI(`/trabajos/${trabajoId}`);
+        if (trabajo.estado !== 'en_proceso') {
+            return trabajo;
+        }
+        await new Promise(resolve => setTimeout(resolve, intervaloMs));
+    }
+    throw new Error('El trabajo tardó demasiado en terminar');
+}
+
 async function importarGlosario() {
     if (!estado.proyectoActual) {
         alert('Selecciona un proyecto primero');
@@ -1027,9 +1036,11 @@ async function importarGlosario() {
     }
 
     try {
-        const resultado = await fetchAPI(`/proyectos/${estado.proyectoActual}/glosario/importar-excel`, {
+        const { trabajo_id } = await fetchAPI(`/proyectos/${estado.proyectoActual}/glosario/importar-excel`, {
             method: 'POST'
         });
+        const trabajo = await esperarTrabajo(trabajo_id);
+        const resultado = trabajo.resultado || {};
 
         if (resultado.error) {
             alert(`Error: ${resultado.error}`);
@@ -1471,21 +1482,26 @@ async function mostrarModalSubirCotizacion() {
     document.getElementById('modal-subir-cotizacion').classList.add('active');
 }
 
-async function cargarCategoriasParaCotizacion() {
-    const container = document.getElementById('cot-categorias-container');
-
-    // Obtener categorías únicas de todos los proyectos (de las partidas)
-    let todasCategorias = new Set();
-
+// Categorías únicas de todos los proyectos (las peticiones por proyecto van en paralelo)
+async function obtenerCategoriasTodosProyectos() {
+    const todasCategorias = new Set();
     try {
         const proyectos = await fetchAPI('/proyectos');
-        for (const p of proyectos) {
-            const categorias = await fetchAPI(`/proyectos/${p.id}/categorias`);
-            categorias.forEach(c => todasCategorias.add(c));
-        }
+        const listas = await Promise.all(
+            proyectos.map(p => fetchAPI(`/proyectos/${p.id}/categorias`))
+        );
+        listas.forEach(categorias => categorias.forEach(c => todasCategorias.add(c)));
     } catch (error) {
         console.error('Error cargando categorías:', error);
     }
+    return todasCategorias;
+}
+
+async function cargarCategoriasParaCotizacion() {
+    const container = document.getElementById('cot-categorias-container');
+
+    // Obtener categorías únicas de todos los proyectos (de las partidas)
+    const todasCategorias = await obtenerCategoriasTodosProyectos();
 
     const categoriasArray = Array.from(todasCategorias).sort();
 
@@ -1598,13 +1614,21 @@ async function procesarCotizacion(event) {
             body: formData
         });
 
-        const resultado = await response.json();
+        const respuesta = await response.json();
 
         if (!response.ok) {
             // Manejar error especifico de PDF no soportado
-            if (resultado.mensaje) {
-                throw new Error(resultado.mensaje);
+            if (respuesta.mensaje) {
+                throw new Error(respuesta.mensaje);
             }
+            throw new Error(respuesta.error || 'Error procesando archivo');
+        }
+
+        // El Excel se procesa en segundo plano: esperar a que termine el trabajo
+        const trabajo = await esperarTrabajo(respuesta.trabajo_id);
+        const resultado = trabajo.resultado || {};
+
+        if (trabajo.estado === 'error') {
             throw new Error(resultado.error || 'Error procesando archivo');
         }
 
@@ -1618,7 +1642,9 @@ async function procesarCotizacion(event) {
 
         // Mostrar items extraídos
         if (resultado.items && resultado.items.length > 0) {
-            alert(`Se extrajeron ${resultado.items.length} items del archivo Excel`);
+            alert(resultado.duplicada
+                ? `Este archivo ya estaba cargado para el proveedor (${resultado.items.length} items). Se muestra la cotización existente.`
+                : `Se extrajeron ${resultado.items.length} items del archivo Excel`);
             await verItemsCotizacion(resultado.cotizacion.id);
         } else {
             alert('No se encontraron items en el archivo. Verifica que el formato sea correcto (columnas: codigo, descripcion, cantidad, precio, importe).');
@@ -1793,16 +1819,7 @@ async function mostrarComparacion() {
     });
 
     // Cargar categorías
-    let todasCategorias = new Set();
-    try {
-        const proyectos = await fetchAPI('/proyectos');
-        for (const p of proyectos) {
-            const categorias = await fetchAPI(`/proyectos/${p.id}/categorias`);
-            categorias.forEach(c => todasCategorias.add(c));
-        }
-    } catch (error) {
-        console.error('Error cargando categorías:', error);
-    }
+    const todasCategorias = await obtenerCategoriasTodosProyectos();
 
     const selectCategoria = document.getElementById('comp-categoria');
     selectCategoria.innerHTML = '<option value="">Todas las categorías</option>';